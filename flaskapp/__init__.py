@@ -15,13 +15,16 @@ load_dotenv(os.path.join(root_dir, '.env'))
 ctpn_dir = os.path.join(root_dir, 'flaskapp', 'analysis', 'ctpn')
 sys.path.append(ctpn_dir)
 
-# Initialise tensorflow session
-from flaskapp.analysis.ctpn.vision_ctpn import create_tf_session
-
-tf_session = create_tf_session(
-    config_filepath=os.path.join(ctpn_dir, 'text.yml'),
-    model_filepath=os.path.join(ctpn_dir, 'ctpn.pb'))
-app.config['tf_session'] = tf_session
+# Load the engines listed in PRELOAD_ENGINES now, others on first use.
+# When gunicorn preloads the app in its master (see gunicorn.conf.py),
+# only the shared weights are loaded here: engines are loaded by each
+# worker after fork, as tensorflow sessions cannot be used across a fork
+from flaskapp.engines import preload_engines, preload_shared_weights
+
+if os.environ.get('GUNICORN_PRELOAD') == '1':
+    preload_shared_weights()
+else:
+    preload_engines()
 
 # Import endpoints
 from flaskapp import routes
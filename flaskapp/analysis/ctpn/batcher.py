@@ -0,0 +1,156 @@
+"""Micro-batching of CTPN forward passes across concurrent requests."""
+
+from typing import List
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from lib.rpn_msr.proposal_layer_tf import split_batch_outputs
+from lib.utils.blob import im_list_to_blob
+
+from flaskapp.analysis.ctpn.model import CTPNModel
+
+
+class _Request(object):
+    """
+    Image blob waiting to be run through the model,
+    and the outputs of the model for it once done
+    """
+
+    def __init__(self, blob: np.ndarray):
+        self.blob = blob
+        self.outputs = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class CTPNBatcher(object):
+    """
+    Collect the image blobs of concurrent requests for a short window
+    and run them through the model in a single forward pass, then hand
+    each request its own slice of the outputs.
+
+    By default only blobs of the same shape are batched together, which
+    gives exactly the same outputs as running them one by one. With
+    pad=True, blobs of different shapes are zero padded to a common
+    shape: more requests share a forward pass, but the outputs of the
+    padded images differ slightly, since the BiLSTM reads whole rows
+    of the feature map including the padding.
+    """
+
+    def __init__(self,
+                 model: CTPNModel,
+                 window_ms: float = 10,
+                 max_batch_size: int = 4,
+                 pad: bool = False):
+        """
+        :param model: CTPN model with graph and config loaded
+        :param window_ms: how long to wait for more requests after the first
+        :param max_batch_size: maximum number of images per forward pass
+        :param pad: whether to batch blobs of different shapes together
+        """
+        self.model = model
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.pad = pad
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @classmethod
+    def from_env(cls, model: CTPNModel):
+        """
+        Configure the batcher from environment variables.
+        Returns None if batching is disabled (CTPN_BATCH_WINDOW_MS=0)
+        """
+        window_ms = float(os.environ.get('CTPN_BATCH_WINDOW_MS', 0))
+        if window_ms <= 0:
+            return None
+        return cls(model=model,
+                   window_ms=window_ms,
+                   max_batch_size=int(os.environ.get('CTPN_MAX_BATCH', 4)),
+                   pad=os.environ.get('CTPN_BATCH_PAD', '0') == '1')
+
+    def _ensure_thread(self):
+        # threads are not inherited by forked processes (gunicorn workers)
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._loop,
+                                                name='ctpn-batcher',
+                                                daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def predict(self, blob: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        Run a single image blob through the model, possibly together with
+        the blobs of concurrent requests, and return its
+        (cls_prob, box_pred) as if it had been run on its own
+        :param blob: (1, H, W, 3) image blob
+        """
+        assert blob.shape[0] == 1, 'Only single item blobs can be batched'
+
+        self._ensure_thread()
+        request = _Request(blob)
+        self._queue.put(request)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def _collect(self) -> List[_Request]:
+        """
+        Wait for a request, then for more requests until the
+        window elapses or the batch is full
+        """
+        batch = [self._queue.get()]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if self.pad:
+                self._run(batch)
+                continue
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.blob.shape, []).append(request)
+            for group in groups.values():
+                self._run(group)
+
+    def _run(self, batch: List[_Request]):
+        try:
+            if len(batch) == 1:
+                blob = batch[0].blob
+            else:
+                blob = im_list_to_blob([request.blob[0] for request in batch])
+
+            cls_prob, box_pred = self.model.predict(blob)
+
+            im_info = np.array([[request.blob.shape[1], request.blob.shape[2], 1]
+                                for request in batch], dtype=np.float32)
+            for request, outputs in zip(batch, split_batch_outputs(cls_prob, box_pred, im_info)):
+                request.outputs = outputs
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        finally:
+            for request in batch:
+                request.done.set()
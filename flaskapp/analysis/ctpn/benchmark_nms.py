@@ -0,0 +1,81 @@
+"""
+Compare the NMS backends on proposals shaped like the ones proposal_layer
+feeds in (RPN_PRE_NMS_TOP_N proposals for a 600x1000 image), on the ones
+left for TextDetector, and on a few hundred proposals (small enough for the
+suppression matrix), and check that all backends keep the same boxes as
+the pure python reference.
+
+Usage:
+    python flaskapp/analysis/ctpn/benchmark_nms.py [repeats]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from lib.fast_rcnn.bbox_transform import bbox_transform_inv, clip_boxes
+from lib.fast_rcnn.config import cfg
+from lib.fast_rcnn.nms_wrapper import NMS_BACKENDS, select_backend
+from lib.rpn_msr.generate_anchors import generate_anchors
+
+
+def make_proposals(height: int = 600,
+                   width: int = 1000,
+                   num_proposals: int = 12000,
+                   seed: int = 0) -> np.ndarray:
+    """
+    Return (num_proposals, 5) dets [x1, y1, x2, y2, score] decoded from
+    random vertical deltas applied to the CTPN anchors of an image
+    """
+    rng = np.random.RandomState(seed)
+    stride = 16
+    anchors = generate_anchors()
+    shift_x, shift_y = np.meshgrid(np.arange(0, width // stride) * stride,
+                                   np.arange(0, height // stride) * stride)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                        shift_x.ravel(), shift_y.ravel())).transpose()
+    anchors = (anchors.reshape((1, -1, 4)) +
+               shifts.reshape((-1, 1, 4))).reshape((-1, 4))
+
+    deltas = np.zeros((anchors.shape[0], 4), np.float32)
+    deltas[:, 1] = rng.normal(0, 0.2, anchors.shape[0])
+    deltas[:, 3] = rng.normal(0, 0.2, anchors.shape[0])
+    proposals = clip_boxes(bbox_transform_inv(anchors, deltas), (height, width))
+
+    scores = rng.rand(anchors.shape[0]).astype(np.float32)
+    order = scores.argsort()[::-1][:num_proposals]
+    return np.hstack((proposals[order], scores[order, np.newaxis]))
+
+
+def benchmark(dets: np.ndarray, thresh: float, repeats: int):
+    print('{} boxes, threshold {}, auto backend: {}'.format(
+        dets.shape[0], thresh, select_backend(dets.shape[0])))
+    reference = None
+    for name in ['python', 'cython', 'gpu', 'matrix', 'sweep', 'column']:
+        if name not in NMS_BACKENDS:
+            print('  {:8} not available'.format(name))
+            continue
+        if name == 'matrix' and dets.shape[0] > 4 * cfg.NMS_MATRIX_MAX:
+            print('  {:8} skipped, too many boxes'.format(name))
+            continue
+        start = time.time()
+        for _ in range(repeats):
+            keep = NMS_BACKENDS[name](dets, thresh)
+        elapsed = (time.time() - start) / repeats
+        if reference is None:
+            reference = list(keep)
+        print('  {:8} {:8.1f} ms  {} kept  {}'.format(
+            name, elapsed * 1000, len(keep),
+            'same' if list(keep) == reference else 'DIFFERENT'))
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    dets = make_proposals()
+    # proposal_layer
+    benchmark(dets, cfg.TEST.RPN_NMS_THRESH, repeats)
+    # TextDetector, on the proposals left after the score threshold
+    benchmark(dets[dets[:, 4] > 0.9], 0.2, repeats)
+    # few proposals, e.g. a small or blank image, where auto picks the matrix
+    benchmark(make_proposals(num_proposals=200), cfg.TEST.RPN_NMS_THRESH, repeats)
@@ -225,6 +225,14 @@ __C.LOG_DIR = 'default'
 # Use GPU implementation of non-maximum suppression
 __C.USE_GPU_NMS = True
 
+# Non-maximum suppression backend (see nms_wrapper.NMS_BACKENDS):
+# gpu, cython, python, matrix, sweep, column, or auto to choose by availability
+# and number of boxes
+__C.NMS_BACKEND = 'auto'
+
+# In auto mode, use the suppression matrix for up to this many boxes
+__C.NMS_MATRIX_MAX = 500
+
 
 
 def get_output_dir(imdb, weights_filename):
@@ -1,23 +1,65 @@
+import logging
+
 import numpy as np
 from .config import cfg
-pure_python_nms = False
+
+logger = logging.getLogger(__name__)
+
+# NMS backends by name. Each takes dets (N, 5) [x1, y1, x2, y2, score]
+# and a threshold, and returns the indices of the kept boxes by
+# decreasing score. The compiled extensions are only registered if built
+NMS_BACKENDS = {}
+
 try:
     from lib.utils.gpu_nms import gpu_nms
+    NMS_BACKENDS['gpu'] = lambda dets, thresh: gpu_nms(
+        dets.astype(np.float32, copy=False), thresh, device_id=cfg.GPU_ID)
+except ImportError:
+    pass
+
+try:
     from ..utils.cython_nms import nms as cython_nms
+    NMS_BACKENDS['cython'] = lambda dets, thresh: cython_nms(
+        dets.astype(np.float32, copy=False), thresh)
 except ImportError:
-    pure_python_nms = True
+    pass
+
+pure_python_nms = not NMS_BACKENDS
+
+# backends already reported in the log
+_logged_backends = set()
+
+
+def select_backend(num_boxes):
+    """
+    Return the name of the backend used to suppress num_boxes boxes:
+    cfg.NMS_BACKEND if it names a backend. Otherwise (auto) the compiled
+    extensions if available, else the suppression matrix for up to
+    cfg.NMS_MATRIX_MAX boxes and the column NMS for more.
+    """
+    if cfg.NMS_BACKEND != 'auto':
+        if cfg.NMS_BACKEND not in NMS_BACKENDS:
+            raise ValueError('NMS backend {} is not available, choose from: {}'.format(
+                cfg.NMS_BACKEND, ', '.join(sorted(NMS_BACKENDS))))
+        return cfg.NMS_BACKEND
+    if cfg.USE_GPU_NMS and 'gpu' in NMS_BACKENDS:
+        return 'gpu'
+    if 'cython' in NMS_BACKENDS:
+        return 'cython'
+    if num_boxes <= cfg.NMS_MATRIX_MAX:
+        return 'matrix'
+    return 'column'
 
 
 def nms(dets, thresh):
     if dets.shape[0] == 0:
         return []
-    if pure_python_nms:
-        # print("Fall back to pure python nms")
-        return py_cpu_nms(dets, thresh)
-    if cfg.USE_GPU_NMS:
-        return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
-    else:
-        return cython_nms(dets, thresh)
+    backend = select_backend(dets.shape[0])
+    if backend not in _logged_backends:
+        # nms runs several times per image, only report each backend once
+        _logged_backends.add(backend)
+        logger.debug('NMS backend %s selected for %d boxes', backend, dets.shape[0])
+    return NMS_BACKENDS[backend](dets, thresh)
 
 
 def py_cpu_nms(dets, thresh):
@@ -45,3 +87,146 @@ def py_cpu_nms(dets, thresh):
         inds = np.where(ovr <= thresh)[0]
         order = order[inds + 1]
     return keep
+
+
+def matrix_nms(dets, thresh):
+    """
+    Same result as py_cpu_nms, computing all pairwise overlaps at once.
+    Memory is O(N^2), so only for small N (cfg.NMS_MATRIX_MAX).
+    """
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    scores = dets[:, 4]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+
+    xx1 = np.maximum(x1[order, np.newaxis], x1[order])
+    yy1 = np.maximum(y1[order, np.newaxis], y1[order])
+    xx2 = np.minimum(x2[order, np.newaxis], x2[order])
+    yy2 = np.minimum(y2[order, np.newaxis], y2[order])
+    w = np.maximum(0.0, xx2 - xx1 + 1)
+    h = np.maximum(0.0, yy2 - yy1 + 1)
+    inter = w * h
+    suppress = inter / (areas[order, np.newaxis] + areas[order] - inter) > thresh
+
+    # rows of boxes already suppressed are skipped, a kept box
+    # suppresses every later box it overlaps
+    suppressed = np.zeros(len(order), np.bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(order[i])
+        suppressed |= suppress[i]
+    return keep
+
+
+def sweep_nms(dets, thresh):
+    """
+    Same result as py_cpu_nms, only comparing each kept box with the
+    boxes that overlap it horizontally: with boxes sorted by x1, those
+    are a contiguous slice found by binary search. Memory is O(N).
+    """
+    # work on boxes sorted by x1, so that slices are views
+    by_x1 = np.argsort(dets[:, 0], kind='mergesort')
+    x1 = dets[by_x1, 0]
+    y1 = dets[by_x1, 1]
+    x2 = dets[by_x1, 2]
+    y2 = dets[by_x1, 3]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = np.empty_like(by_x1)
+    order[by_x1] = np.arange(len(by_x1))
+    order = order[dets[:, 4].argsort()[::-1]]
+
+    # boxes overlapping box i have x1 in (x1[i] - 1 - max width, x2[i] + 1)
+    starts = np.searchsorted(x1, x1 - 1 - np.max(x2 - x1), side='left')
+    ends = np.searchsorted(x1, x2 + 1, side='right')
+
+    suppressed = np.zeros(dets.shape[0], np.bool)
+    keep = []
+    for i in order.tolist():
+        if suppressed[i]:
+            continue
+        keep.append(by_x1[i])
+        s, e = starts[i], ends[i]
+        xx1 = np.maximum(x1[i], x1[s:e])
+        yy1 = np.maximum(y1[i], y1[s:e])
+        xx2 = np.minimum(x2[i], x2[s:e])
+        yy2 = np.minimum(y2[i], y2[s:e])
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        # suppressing an already suppressed or kept box again is harmless
+        suppressed[s:e] |= inter / (areas[i] + areas[s:e] - inter) > thresh
+    return keep
+
+
+def column_nms(dets, thresh):
+    """
+    Same result as py_cpu_nms, for proposals anchored to feature map
+    columns such as CTPN's (fixed width boxes starting at multiples of the
+    feature stride). Boxes are grouped by x1 into columns, and when boxes
+    of different columns cannot overlap by more than thresh, each column
+    is suppressed independently: all columns advance together, one kept
+    box per column per round. Falls back to sweep_nms otherwise.
+    """
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    scores = dets[:, 4]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+
+    columns, column_ids = np.unique(x1, return_inverse=True)
+    column_x2 = np.full(len(columns), -np.inf)
+    np.maximum.at(column_x2, column_ids, x2)
+
+    # the IoU of boxes from different columns is at most their horizontal
+    # overlap divided by the width of the narrowest box
+    min_width = np.min(x2 - x1 + 1)
+    min_height = np.min(y2 - y1 + 1)
+    max_overlap = np.max(column_x2[:-1] - columns[1:] + 1) if len(columns) > 1 else 0
+    if min_width <= 0 or min_height <= 0 or \
+            (max_overlap > 0 and not max_overlap < thresh * min_width * (1 - 1e-6)):
+        return sweep_nms(dets, thresh)
+
+    # boxes sorted by column, then by decreasing score (rank in order)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    boxes = np.lexsort((ranks, column_ids))
+    box_columns = column_ids[boxes]
+
+    kept = np.zeros(len(boxes), np.bool)
+    alive = np.ones(len(boxes), np.bool)
+    while alive.any():
+        # keep the highest scoring box left in each column
+        remaining = np.flatnonzero(alive)
+        is_head = np.ones(len(remaining), np.bool)
+        is_head[1:] = box_columns[remaining[1:]] != box_columns[remaining[:-1]]
+        kept[remaining[is_head]] = True
+
+        # and suppress the boxes of its column that it overlaps
+        i = boxes[remaining[is_head][np.cumsum(is_head) - 1]]
+        j = boxes[remaining]
+        xx1 = np.maximum(x1[i], x1[j])
+        yy1 = np.maximum(y1[i], y1[j])
+        xx2 = np.minimum(x2[i], x2[j])
+        yy2 = np.minimum(y2[i], y2[j])
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        alive[remaining] = ~is_head & (inter / (areas[i] + areas[j] - inter) <= thresh)
+
+    return list(order[np.sort(ranks[boxes[kept]])])
+
+
+NMS_BACKENDS['python'] = py_cpu_nms
+NMS_BACKENDS['matrix'] = matrix_nms
+NMS_BACKENDS['sweep'] = sweep_nms
+NMS_BACKENDS['column'] = column_nms
@@ -4,29 +4,40 @@ from .config import cfg
 from lib.utils.blob import im_list_to_blob
 
 
-def _get_image_blob(im):
-    im_orig = im.astype(np.float32, copy=True)
-    im_orig -= cfg.PIXEL_MEANS
-
-    im_shape = im_orig.shape
+def _get_image_scale(im_shape, target_size):
     im_size_min = np.min(im_shape[0:2])
     im_size_max = np.max(im_shape[0:2])
+    im_scale = float(target_size) / float(im_size_min)
+    # Prevent the biggest axis from being more than MAX_SIZE
+    if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
+        im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
+    return im_scale
 
-    processed_ims = []
-    im_scale_factors = []
 
-    for target_size in cfg.TEST.SCALES:
-        im_scale = float(target_size) / float(im_size_min)
-        # Prevent the biggest axis from being more than MAX_SIZE
-        if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
-            im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
-        im = cv2.resize(im_orig, None, None, fx=im_scale, fy=im_scale,
-                        interpolation=cv2.INTER_LINEAR)
-        im_scale_factors.append(im_scale)
-        processed_ims.append(im)
+def _get_image_blob(im):
+    im_scale_factors = [_get_image_scale(im.shape, target_size)
+                        for target_size in cfg.TEST.SCALES]
 
-    # Create a blob to hold the input images
-    blob = im_list_to_blob(processed_ims)
+    if len(im_scale_factors) > 1:
+        processed_ims = []
+        im_orig = im.astype(np.float32, copy=True)
+        im_orig -= cfg.PIXEL_MEANS
+        for im_scale in im_scale_factors:
+            processed_ims.append(cv2.resize(im_orig, None, None, fx=im_scale, fy=im_scale,
+                                            interpolation=cv2.INTER_LINEAR))
+
+        # Create a blob to hold the input images
+        blob = im_list_to_blob(processed_ims)
+        return blob, np.array(im_scale_factors)
+
+    # Single scale: resize the image as is (if needed at all), then
+    # subtract the means straight into the blob, without intermediate copies
+    im_scale = im_scale_factors[0]
+    if im_scale != 1.0:
+        im = cv2.resize(im, None, None, fx=im_scale, fy=im_scale,
+                        interpolation=cv2.INTER_LINEAR)
+    blob = np.empty((1,) + im.shape, dtype=np.float32)
+    np.subtract(im, cfg.PIXEL_MEANS, out=blob[0], casting='unsafe')
 
     return blob, np.array(im_scale_factors)
 
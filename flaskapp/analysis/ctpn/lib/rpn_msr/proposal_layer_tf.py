@@ -1,4 +1,5 @@
 # -*- coding:utf-8 -*-
+from functools import lru_cache
 import numpy as np
 from .generate_anchors import generate_anchors
 from lib.fast_rcnn.config import cfg
@@ -7,11 +8,45 @@ from lib.fast_rcnn.nms_wrapper import nms
 
 
 DEBUG = False
+
+# number of feature map shapes whose anchors are kept, detection images
+# are bounded in size (TextLineCfg.SCALE/MAX_SCALE) so only a few shapes occur
+ANCHOR_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=ANCHOR_CACHE_SIZE)
+def shifted_anchors(height, width, feat_stride=(16,), anchor_scales=(16,), dtype=np.float32):
+    """
+    Return the (height x width x A, 4) anchors of all cells of a feature map,
+    ordered by (h, w, a) like the RPN outputs. Arrays are cached by
+    arguments and shared between calls, so they are read-only.
+    """
+    _anchors = generate_anchors(scales=np.array(anchor_scales))
+    A = _anchors.shape[0]
+
+    # Enumerate all shifts
+    shift_x = np.arange(0, width) * np.array(feat_stride)
+    shift_y = np.arange(0, height) * np.array(feat_stride)
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                        shift_x.ravel(), shift_y.ravel())).transpose()
+
+    # add A anchors (1, A, 4) to
+    # cell K shifts (K, 1, 4) to get
+    # shift anchors (K, A, 4)
+    # reshape to (K*A, 4) shifted anchors
+    K = shifts.shape[0]
+    anchors = _anchors.reshape((1, A, 4)) + \
+              shifts.reshape((1, K, 4)).transpose((1, 0, 2))
+    anchors = anchors.reshape((K * A, 4)).astype(dtype)
+    anchors.setflags(write=False)
+    return anchors
+
 """
 Outputs object detection proposals by applying estimated bounding-box
 transformations to a set of regular boxes (called "anchors").
 """
-def proposal_layer(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, cfg_key, _feat_stride = [16,], anchor_scales = [16,]):
+def proposal_layer(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, cfg_key, _feat_stride = [16,], anchor_scales = [16,], min_score = None):
     """
     Parameters
     ----------
@@ -22,6 +57,8 @@ def proposal_layer(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, cfg_key, _feat_
     cfg_key: 'TRAIN' or 'TEST'
     _feat_stride: the downsampling ratio of feature map to the original input image
     anchor_scales: the scales to the basic_anchor (basic anchor is [16, 16])
+    min_score: if given, drop proposals scoring min_score or less before
+               decoding them, e.g. when only those are used afterwards
     ----------
     Returns
     ----------
@@ -43,8 +80,7 @@ def proposal_layer(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, cfg_key, _feat_
 
     """
     # cfg_key=cfg_key.decode('ascii')
-    _anchors = generate_anchors(scales=np.array(anchor_scales))#生成基本的9个anchor
-    _num_anchors = _anchors.shape[0]#9个anchor
+    _num_anchors = generate_anchors(scales=np.array(anchor_scales)).shape[0]#9个anchor
 
     im_info = im_info[0]#原始图像的高宽、缩放尺度
 
@@ -52,8 +88,6 @@ def proposal_layer(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, cfg_key, _feat_
         'Only single item batches are supported'
 
     pre_nms_topN  = cfg[cfg_key].RPN_PRE_NMS_TOP_N#12000,在做nms之前，最多保留的候选box数目
-    post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N#2000，做完nms之后，最多保留的box的数目
-    nms_thresh    = cfg[cfg_key].RPN_NMS_THRESH#nms用参数，阈值是0.7
     min_size      = cfg[cfg_key].RPN_MIN_SIZE#候选box的最小尺寸，目前是16，高宽均要大于16
     #TODO 后期需要修改这个最小尺寸，改为8？
 
@@ -78,25 +112,11 @@ def proposal_layer(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, cfg_key, _feat_
     if DEBUG:
         print('score map size: {}'.format(scores.shape))
 
-    # Enumerate all shifts
     # 同anchor-target-layer-tf这个文件一样，生成anchor的shift，进一步得到整张图像上的所有anchor
-    shift_x = np.arange(0, width) * _feat_stride
-    shift_y = np.arange(0, height) * _feat_stride
-    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                        shift_x.ravel(), shift_y.ravel())).transpose()
-
-    # Enumerate all shifted anchors:
-    #
-    # add A anchors (1, A, 4) to
-    # cell K shifts (K, 1, 4) to get
-    # shift anchors (K, A, 4)
-    # reshape to (K*A, 4) shifted anchors
-    A = _num_anchors
-    K = shifts.shape[0]
-    anchors = _anchors.reshape((1, A, 4)) + \
-              shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-    anchors = anchors.reshape((K * A, 4))#这里得到的anchor就是整张图像上的所有anchor
+    # (cached by feature map shape, in the dtype of the deltas so that
+    # bbox_transform_inv does not copy them)
+    anchors = shifted_anchors(height, width, tuple(np.ravel(_feat_stride)),
+                              tuple(np.ravel(anchor_scales)), bbox_deltas.dtype)
 
     # Transpose and reshape predicted bbox transformations to get them
     # into the same order as the anchors:
@@ -109,34 +129,47 @@ def proposal_layer(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, cfg_key, _feat_
     # Same story for the scores:
     scores = scores.reshape((-1, 1))
 
-    # Convert anchors into proposals via bbox transformations
-    proposals = bbox_transform_inv(anchors, bbox_deltas)#做逆变换，得到box在图像上的真实坐标
-
-    # 2. clip predicted boxes to image
-    proposals = clip_boxes(proposals, im_info[:2])#将所有的proposal修建一下，超出图像范围的将会被修剪掉
-
-    # 3. remove predicted boxes with either height or width < threshold
-    # (NOTE: convert min_size to input image scale stored in im_info[2])
-    keep = _filter_boxes(proposals, min_size * im_info[2])#移除那些proposal小于一定尺寸的proposal
+    # 4. sort all (proposal, score) pairs by score from highest to lowest
+    # 5. take top pre_nms_topN (e.g. 6000)
+    # Only the anchors that can survive are decoded: those scoring above
+    # min_score, and only the top pre_nms_topN of them (partial selection
+    # instead of sorting all H x W x A scores)
+    if min_score is None:
+        candidates = np.arange(scores.shape[0])
+    else:
+        candidates = np.where(scores.ravel() > min_score)[0]
+    k = pre_nms_topN#保留12000个proposal进去做nms
+    while True:
+        selected = candidates[_top_k(scores.ravel()[candidates], k)]
+        proposals, keep = _decode_proposals(anchors[selected], bbox_deltas[selected],
+                                            im_info, min_size)
+        if pre_nms_topN <= 0 or len(keep) >= pre_nms_topN or len(selected) == len(candidates):
+            break
+        # boxes that were too small left room for lower scoring candidates
+        k *= 2
+    if pre_nms_topN > 0:
+        keep = keep[:pre_nms_topN]
     proposals = proposals[keep, :]#保留剩下的proposal
-    scores = scores[keep]
-    bbox_deltas=bbox_deltas[keep,:]
+    selected = selected[keep]
+    scores = scores[selected]
+    bbox_deltas = bbox_deltas[selected, :]
 
 
-    # # remove irregular boxes, too fat too tall
-    # keep = _filter_irregular_boxes(proposals)
-    # proposals = proposals[keep, :]
-    # scores = scores[keep]
+    return nms_proposals(proposals, scores, bbox_deltas, cfg_key)
 
-    # 4. sort all (proposal, score) pairs by score from highest to lowest
-    # 5. take top pre_nms_topN (e.g. 6000)
-    order = scores.ravel().argsort()[::-1]#score按得分的高低进行排序
-    if pre_nms_topN > 0:                #保留12000个proposal进去做nms
-        order = order[:pre_nms_topN]
-    proposals = proposals[order, :]
-    scores = scores[order]
-    bbox_deltas=bbox_deltas[order,:]
 
+def nms_proposals(proposals, scores, bbox_deltas, cfg_key):
+    """
+    Last steps of proposal_layer, for (proposals, scores, bbox_deltas)
+    already decoded and sorted by decreasing score: NMS, then keep the
+    top RPN_POST_NMS_TOP_N proposals
+    ----------
+    Returns
+    ----------
+    rpn_rois : (N, 5) e.g. [score, x1, y1, x2, y2], bbox_deltas: (N, 4)
+    """
+    post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N#2000，做完nms之后，最多保留的box的数目
+    nms_thresh    = cfg[cfg_key].RPN_NMS_THRESH#nms用参数，阈值是0.7
 
     # 6. apply nms (e.g. threshold = 0.7)
     # 7. take after_nms_topN (e.g. 300)
@@ -157,6 +190,60 @@ def proposal_layer(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, cfg_key, _feat_
     return blob,bbox_deltas
 
 
+def _top_k(scores, k):
+    """
+    Indices of the k highest scores (all scores if k <= 0), by decreasing
+    score, found by partial selection rather than sorting all scores
+    """
+    if 0 < k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='mergesort')]
+
+
+def _decode_proposals(anchors, bbox_deltas, im_info, min_size):
+    """
+    Decode proposals from anchors and deltas, clip them to the image and
+    return them with the indices of those at least min_size (at image scale)
+    """
+    # Convert anchors into proposals via bbox transformations
+    proposals = bbox_transform_inv(anchors, bbox_deltas)#做逆变换，得到box在图像上的真实坐标
+
+    # 2. clip predicted boxes to image
+    proposals = clip_boxes(proposals, im_info[:2])#将所有的proposal修建一下，超出图像范围的将会被修剪掉
+
+    # 3. remove predicted boxes with either height or width < threshold
+    # (NOTE: convert min_size to input image scale stored in im_info[2])
+    keep = _filter_boxes(proposals, min_size * im_info[2])#移除那些proposal小于一定尺寸的proposal
+    return proposals, keep
+
+
+def split_batch_outputs(rpn_cls_prob_reshape, rpn_bbox_pred, im_info, _feat_stride = [16,]):
+    """
+    Split RPN outputs of a batch of (zero padded) images into one
+    single item batch per image, cropped to the part of the feature map
+    that covers the image itself.
+    ----------
+    rpn_cls_prob_reshape: (N , H , W , Ax2)
+    rpn_bbox_pred: (N , H , W , Ax4)
+    im_info: (N, 3) array of [image_height, image_width, scale_ratio]
+    ----------
+    Returns
+    ----------
+    list of N (rpn_cls_prob_reshape, rpn_bbox_pred) of shapes
+    (1, h, w, Ax2) and (1, h, w, Ax4)
+    """
+    outputs = []
+    for i in range(rpn_cls_prob_reshape.shape[0]):
+        # every pooling layer of VGG16 halves the size, rounding down
+        height = min(int(im_info[i][0]) // _feat_stride[0], rpn_cls_prob_reshape.shape[1])
+        width = min(int(im_info[i][1]) // _feat_stride[0], rpn_cls_prob_reshape.shape[2])
+        outputs.append((rpn_cls_prob_reshape[i:i + 1, :height, :width],
+                        rpn_bbox_pred[i:i + 1, :height, :width]))
+    return outputs
+
+
 def _filter_boxes(boxes, min_size):
     """Remove all boxes with any side smaller than min_size."""
     ws = boxes[:, 2] - boxes[:, 0] + 1
@@ -21,9 +21,10 @@ class TextDetector:
         keep_inds=np.where(scores>TextLineCfg.TEXT_PROPOSALS_MIN_SCORE)[0]
         text_proposals, scores=text_proposals[keep_inds], scores[keep_inds]
 
-        # 按得分排序
-        sorted_indices=np.argsort(scores.ravel())[::-1]
-        text_proposals, scores=text_proposals[sorted_indices], scores[sorted_indices]
+        # 按得分排序 (proposals from proposal_layer are already sorted)
+        if np.any(scores.ravel()[1:]>scores.ravel()[:-1]):
+            sorted_indices=np.argsort(scores.ravel())[::-1]
+            text_proposals, scores=text_proposals[sorted_indices], scores[sorted_indices]
 
         # 对proposal做nms
         keep_inds=nms(np.hstack((text_proposals, scores)), TextLineCfg.TEXT_PROPOSALS_NMS_THRESH)
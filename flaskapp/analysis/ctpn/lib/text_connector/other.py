@@ -12,19 +12,56 @@ def clip_boxes(boxes, im_shape):
     boxes[:, 1::2]=threshold(boxes[:, 1::2], 0, im_shape[0]-1)
     return boxes
 
+def group_segments(groups):
+    """
+    Flatten groups of indices into one array, and return it with the start
+    and length of each group, to reduce all groups at once with reduceat
+    """
+    lengths=np.array([len(group) for group in groups], np.int64)
+    starts=np.cumsum(lengths)-lengths
+    return np.concatenate(groups).astype(np.int64), starts, lengths
+
+def fit_lines(X, Y, starts, lengths):
+    """
+    Least squares fit of a line y=k*x+b to each segment of X, Y, returning
+    the arrays k, b. Segments where all X are equal get the line y=Y[0].
+    """
+    mean_x=np.add.reduceat(X, starts)/lengths
+    mean_y=np.add.reduceat(Y, starts)/lengths
+    centered_x=X-np.repeat(mean_x, lengths)
+    centered_y=Y-np.repeat(mean_y, lengths)
+    sxx=np.add.reduceat(centered_x*centered_x, starts)
+    sxy=np.add.reduceat(centered_x*centered_y, starts)
+
+    vertical=np.maximum.reduceat(X, starts)==np.minimum.reduceat(X, starts)
+    k=np.where(vertical, 0, sxy/np.where(vertical, 1, sxx))
+    b=np.where(vertical, Y[starts], mean_y-k*mean_x)
+    return k, b
+
 
 class Graph:
-    def __init__(self, graph):
-        self.graph=graph
+    """
+        Graph of text proposals where each node has at most one successor,
+        stored as an array of successor indices (-1 for no successor)
+        instead of a dense N x N adjacency matrix.
+    """
+    def __init__(self, successors):
+        self.successors=successors
 
     def sub_graphs_connected(self):
+        """
+            Return the chains of nodes starting at each node that has a
+            successor but no precursor, in node order
+        """
+        has_precursor=np.zeros(len(self.successors), np.bool)
+        has_precursor[self.successors[self.successors>=0]]=True
+        starts=np.where(~has_precursor & (self.successors>=0))[0]
+
+        successors=self.successors.tolist()
         sub_graphs=[]
-        for index in range(self.graph.shape[0]):
-            if not self.graph[:, index].any() and self.graph[index, :].any():
-                v=index
-                sub_graphs.append([v])
-                while self.graph[v, :].any():
-                    v=np.where(self.graph[v, :])[0][0]
-                    sub_graphs[-1].append(v)
+        for v in starts.tolist():
+            sub_graphs.append([v])
+            while successors[v]>=0:
+                v=successors[v]
+                sub_graphs[-1].append(v)
         return sub_graphs
-
@@ -1,5 +1,5 @@
 import numpy as np
-from .other import clip_boxes
+from .other import clip_boxes, group_segments, fit_lines
 from .text_proposal_graph_builder import TextProposalGraphBuilder
 
 class TextProposalConnector:
@@ -10,55 +10,40 @@ class TextProposalConnector:
         graph=self.graph_builder.build_graph(text_proposals, scores, im_size)
         return graph.sub_graphs_connected()
 
-    def fit_y(self, X, Y, x1, x2):
-        len(X)!=0
-        # if X only include one point, the function will get line y=Y[0]
-        if np.sum(X==X[0])==len(X):
-            return Y[0], Y[0]
-        p=np.poly1d(np.polyfit(X, Y, 1))
-        return p(x1), p(x2)
-
     def get_text_lines(self, text_proposals, scores, im_size):
         # tp=text proposal
         tp_groups=self.group_text_proposals(text_proposals, scores, im_size)
-        text_lines=np.zeros((len(tp_groups), 5), np.float32)
+        if len(tp_groups)==0:
+            return np.zeros((0, 9), np.float)
 
-        for index, tp_indices in enumerate(tp_groups):
-            text_line_boxes=text_proposals[list(tp_indices)]
+        # fit all text lines at once, each group being a segment of tp_indices
+        tp_indices, starts, lengths=group_segments(tp_groups)
+        text_line_boxes=text_proposals[tp_indices]
 
-            x0=np.min(text_line_boxes[:, 0])
-            x1=np.max(text_line_boxes[:, 2])
+        x0=np.minimum.reduceat(text_line_boxes[:, 0], starts)
+        x1=np.maximum.reduceat(text_line_boxes[:, 2], starts)
 
-            offset=(text_line_boxes[0, 2]-text_line_boxes[0, 0])*0.5
+        offset=(text_line_boxes[starts, 2]-text_line_boxes[starts, 0])*0.5
 
-            lt_y, rt_y=self.fit_y(text_line_boxes[:, 0], text_line_boxes[:, 1], x0+offset, x1-offset)
-            lb_y, rb_y=self.fit_y(text_line_boxes[:, 0], text_line_boxes[:, 3], x0+offset, x1-offset)
+        # if X only include one point, the line is y=Y[0]
+        k, b=fit_lines(text_line_boxes[:, 0], text_line_boxes[:, 1], starts, lengths)
+        lt_y, rt_y=k*(x0+offset)+b, k*(x1-offset)+b
+        k, b=fit_lines(text_line_boxes[:, 0], text_line_boxes[:, 3], starts, lengths)
+        lb_y, rb_y=k*(x0+offset)+b, k*(x1-offset)+b
 
-            # the score of a text line is the average score of the scores
-            # of all text proposals contained in the text line
-            score=scores[list(tp_indices)].sum()/float(len(tp_indices))
+        # the score of a text line is the average score of the scores
+        # of all text proposals contained in the text line
+        score=np.add.reduceat(scores.ravel()[tp_indices], starts)/lengths
 
-            text_lines[index, 0]=x0
-            text_lines[index, 1]=min(lt_y, rt_y)
-            text_lines[index, 2]=x1
-            text_lines[index, 3]=max(lb_y, rb_y)
-            text_lines[index, 4]=score
+        text_lines=np.zeros((len(tp_groups), 5), np.float32)
+        text_lines[:, 0]=x0
+        text_lines[:, 1]=np.minimum(lt_y, rt_y)
+        text_lines[:, 2]=x1
+        text_lines[:, 3]=np.maximum(lb_y, rb_y)
+        text_lines[:, 4]=score
 
         text_lines=clip_boxes(text_lines, im_size)
 
-        text_recs = np.zeros((len(text_lines), 9), np.float)
-        index = 0
-        for line in text_lines:
-            xmin,ymin,xmax,ymax=line[0],line[1],line[2],line[3]
-            text_recs[index, 0] = xmin
-            text_recs[index, 1] = ymin
-            text_recs[index, 2] = xmax
-            text_recs[index, 3] = ymin
-            text_recs[index, 4] = xmin
-            text_recs[index, 5] = ymax
-            text_recs[index, 6] = xmax
-            text_recs[index, 7] = ymax
-            text_recs[index, 8] = line[4]
-            index = index + 1
-
+        # xmin, ymin, xmax, ymin, xmin, ymax, xmax, ymax, score
+        text_recs=text_lines[:, [0, 1, 2, 1, 0, 3, 2, 3, 4]].astype(np.float)
         return text_recs
@@ -6,73 +6,81 @@ import numpy as np
 class TextProposalGraphBuilder:
     """
         Build Text proposals into a graph.
-    """
-    def get_successions(self, index):
-            box=self.text_proposals[index]
-            results=[]
-            for left in range(int(box[0])+1, min(int(box[0])+TextLineCfg.MAX_HORIZONTAL_GAP+1, self.im_size[1])):
-                adj_box_indices=self.boxes_table[left]
-                for adj_box_index in adj_box_indices:
-                    if self.meet_v_iou(adj_box_index, index):
-                        results.append(adj_box_index)
-                if len(results)!=0:
-                    return results
-            return results
 
-    def get_precursors(self, index):
-        box=self.text_proposals[index]
-        results=[]
-        for left in range(int(box[0])-1, max(int(box[0]-TextLineCfg.MAX_HORIZONTAL_GAP), 0)-1, -1):
-            adj_box_indices=self.boxes_table[left]
-            for adj_box_index in adj_box_indices:
-                if self.meet_v_iou(adj_box_index, index):
-                    results.append(adj_box_index)
-            if len(results)!=0:
-                return results
-        return results
+        All candidate pairs (a proposal and a proposal starting at most
+        MAX_HORIZONTAL_GAP columns to its right) are generated at once from
+        the proposals sorted by column, and filtered in bulk, instead of
+        scanning columns proposal by proposal.
+    """
+    def meet_v_iou(self, index1, index2):
+        """
+            Vertical overlap and size similarity criteria, for arrays of
+            proposal indices
+        """
+        h1=self.heights[index1]
+        h2=self.heights[index2]
+        y0=np.maximum(self.text_proposals[index2, 1], self.text_proposals[index1, 1])
+        y1=np.minimum(self.text_proposals[index2, 3], self.text_proposals[index1, 3])
+        overlaps_v=np.maximum(0, y1-y0+1)/np.minimum(h1, h2)
+        size_similarity=np.minimum(h1, h2)/np.maximum(h1, h2)
+        return (overlaps_v>=TextLineCfg.MIN_V_OVERLAPS) & \
+               (size_similarity>=TextLineCfg.MIN_SIZE_SIM)
 
-    def is_succession_node(self, index, succession_index):
-        precursors=self.get_precursors(succession_index)
-        if self.scores[index]>=np.max(self.scores[precursors]):
-            return True
-        return False
+    def candidate_pairs(self):
+        """
+            Return (left, right) index arrays of all pairs of proposals where
+            right starts 1 to MAX_HORIZONTAL_GAP columns after left and
+            the pair meets the vertical overlap criteria
+        """
+        columns=self.columns
+        # stable sort, so that proposals of a column stay in index order
+        order=np.argsort(columns, kind='mergesort')
+        sorted_columns=columns[order]
 
-    def meet_v_iou(self, index1, index2):
-        def overlaps_v(index1, index2):
-            h1=self.heights[index1]
-            h2=self.heights[index2]
-            y0=max(self.text_proposals[index2][1], self.text_proposals[index1][1])
-            y1=min(self.text_proposals[index2][3], self.text_proposals[index1][3])
-            return max(0, y1-y0+1)/min(h1, h2)
+        starts=np.searchsorted(sorted_columns, columns+1, side='left')
+        ends=np.searchsorted(sorted_columns,
+                             np.minimum(columns+TextLineCfg.MAX_HORIZONTAL_GAP, self.im_size[1]-1),
+                             side='right')
+        counts=np.maximum(ends-starts, 0)
 
-        def size_similarity(index1, index2):
-            h1=self.heights[index1]
-            h2=self.heights[index2]
-            return min(h1, h2)/max(h1, h2)
+        left=np.repeat(np.arange(len(columns)), counts)
+        offsets=np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)
+        right=order[np.repeat(starts, counts)+offsets]
 
-        return overlaps_v(index1, index2)>=TextLineCfg.MIN_V_OVERLAPS and \
-               size_similarity(index1, index2)>=TextLineCfg.MIN_SIZE_SIM
+        keep=self.meet_v_iou(left, right)
+        return left[keep], right[keep]
 
     def build_graph(self, text_proposals, scores, im_size):
         self.text_proposals=text_proposals
-        self.scores=scores
+        self.scores=scores.ravel()
         self.im_size=im_size
         self.heights=text_proposals[:, 3]-text_proposals[:, 1]+1
+        self.columns=text_proposals[:, 0].astype(int)
+
+        n=text_proposals.shape[0]
+        successors=np.full(n, -1, np.int64)
+
+        left, right=self.candidate_pairs()
+        if len(left)==0:
+            return Graph(successors)
+        gaps=self.columns[right]-self.columns[left]
 
-        boxes_table=[[] for _ in range(self.im_size[1])]
-        for index, box in enumerate(text_proposals):
-            boxes_table[int(box[0])].append(index)
-        self.boxes_table=boxes_table
+        # successions of a proposal are its pairs in the nearest column,
+        # the chosen one has the highest score (lowest index on ties)
+        order=np.lexsort((right, -self.scores[right], gaps, left))
+        first=np.unique(left[order], return_index=True)[1]
+        indices=left[order][first]
+        succession_indices=right[order][first]
 
-        graph=np.zeros((text_proposals.shape[0], text_proposals.shape[0]), np.bool)
+        # precursors of a proposal are its pairs in the nearest column to
+        # the left, keep the highest score among them
+        order=np.lexsort((-self.scores[left], gaps, right))
+        first=np.unique(right[order], return_index=True)[1]
+        max_precursor_scores=np.full(n, -np.inf)
+        max_precursor_scores[right[order][first]]=self.scores[left[order][first]]
 
-        for index, box in enumerate(text_proposals):
-            successions=self.get_successions(index)
-            if len(successions)==0:
-                continue
-            succession_index=successions[np.argmax(scores[successions])]
-            if self.is_succession_node(index, succession_index):
-                # NOTE: a box can have multiple successions(precursors) if multiple successions(precursors)
-                # have equal scores.
-                graph[index, succession_index]=True
-        return Graph(graph)
+        # NOTE: a box has at most one succession, but can have multiple precursors
+        # if multiple precursors have equal scores.
+        is_succession=self.scores[indices]>=max_precursor_scores[succession_indices]
+        successors[indices[is_succession]]=succession_indices[is_succession]
+        return Graph(successors)
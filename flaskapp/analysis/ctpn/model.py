@@ -0,0 +1,233 @@
+"""Loading and thread-safe inference of the pre-trained CTPN model."""
+
+from typing import Dict, List, Text
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.platform import gfile
+
+from lib.fast_rcnn.config import cfg, cfg_from_file
+from lib.rpn_msr.generate_anchors import generate_anchors
+
+
+def create_tf_session(config_filepath: Text = './text.yml',
+                      model_filepath: Text = './ctpn.pb',
+                      intra_op_threads: int = 0,
+                      inter_op_threads: int = 0) -> tf.Session:
+    """
+    Initialise a tensorflow session with given config/model
+    :param config_filepath: filepath to configuration yaml file
+    :param model_filepath: filepath to pre-trained model
+    :param intra_op_threads: threads used within an op, 0 lets tensorflow decide
+    :param inter_op_threads: ops run in parallel, 0 lets tensorflow decide
+    """
+    # merge YAML config into default options __C (easydict)
+    cfg_from_file(config_filepath)
+
+    # Initialize a session with allow_soft_placement set to True.
+    config = tf.ConfigProto(allow_soft_placement=True,
+                            intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+    sess = tf.Session(config=config)
+
+    with gfile.FastGFile(model_filepath, 'rb') as f:
+        # Initialize graph object
+        graph_def = tf.GraphDef()
+
+        # Read graph from file
+        graph_def.ParseFromString(f.read())
+
+        # Redundant? sets session to run with default graph?
+        sess.graph.as_default()
+
+        # Import the graph from graph_def into current default graph
+        tf.import_graph_def(graph_def, name='')
+
+        # Initialise ALL variables to hold specific values, and run the session
+        # variables are added to GLOBAL_VARIABLES collection by default
+        sess.run(tf.global_variables_initializer())
+
+    return sess
+
+
+def add_proposal_ops(cls_prob: tf.Tensor,
+                     box_pred: tf.Tensor,
+                     anchor_scales: List[int],
+                     feat_stride: int = 16) -> Dict[Text, tf.Tensor]:
+    """
+    Append the first steps of proposal_layer to the graph of the RPN
+    outputs: foreground scores, score threshold, bbox decoding, clipping,
+    size filter and top-k, so that only the candidate proposals (sorted by
+    decreasing score) are copied out of the session. Single image only.
+    Returns the input placeholders (im_info, min_score, min_size, top_k)
+    and outputs (scores, proposals, bbox_deltas) by name.
+    :param cls_prob: (1, H, W, Ax2) RPN class probabilities
+    :param box_pred: (1, H, W, Ax4) RPN bbox deltas
+    :param anchor_scales: scales of the anchors, as in proposal_layer
+    :param feat_stride: downsampling ratio of the feature map
+    """
+    base_anchors = generate_anchors(scales=np.array(anchor_scales)).astype(np.float32)
+    num_anchors = base_anchors.shape[0]
+
+    with tf.name_scope('proposals'):
+        # [image_height, image_width, scale_ratio]
+        im_info = tf.placeholder(tf.float32, [3], name='im_info')
+        min_score = tf.placeholder_with_default(float('-inf'), [], name='min_score')
+        min_size = tf.placeholder(tf.float32, [], name='min_size')
+        top_k = tf.placeholder(tf.int32, [], name='top_k')
+
+        # anchors of all cells, ordered by (h, w, a) like the RPN outputs
+        shape = tf.shape(cls_prob)
+        shift_x = tf.cast(tf.range(shape[2]) * feat_stride, tf.float32)
+        shift_y = tf.cast(tf.range(shape[1]) * feat_stride, tf.float32)
+        shift_x, shift_y = tf.meshgrid(shift_x, shift_y)
+        shift_x = tf.reshape(shift_x, [-1])
+        shift_y = tf.reshape(shift_y, [-1])
+        shifts = tf.stack([shift_x, shift_y, shift_x, shift_y], axis=1)
+        anchors = tf.reshape(base_anchors[np.newaxis] + shifts[:, tf.newaxis], [-1, 4])
+
+        # the second set of channels are the foreground probabilities
+        scores = tf.reshape(tf.reshape(cls_prob, [-1, num_anchors, 2])[:, :, 1], [-1])
+        bbox_deltas = tf.reshape(box_pred, [-1, 4])
+
+        candidates = tf.reshape(tf.where(scores > min_score), [-1])
+        scores = tf.gather(scores, candidates)
+        anchors = tf.gather(anchors, candidates)
+        bbox_deltas = tf.gather(bbox_deltas, candidates)
+
+        # bbox_transform_inv, CTPN only regresses the vertical position/height
+        widths = anchors[:, 2] - anchors[:, 0] + 1.0
+        heights = anchors[:, 3] - anchors[:, 1] + 1.0
+        ctr_x = anchors[:, 0] + 0.5 * widths
+        ctr_y = anchors[:, 1] + 0.5 * heights
+        pred_ctr_y = bbox_deltas[:, 1] * heights + ctr_y
+        pred_h = tf.exp(bbox_deltas[:, 3]) * heights
+
+        # clip_boxes
+        max_x = im_info[1] - 1
+        max_y = im_info[0] - 1
+        x1 = tf.maximum(tf.minimum(ctr_x - 0.5 * widths, max_x), 0.0)
+        y1 = tf.maximum(tf.minimum(pred_ctr_y - 0.5 * pred_h, max_y), 0.0)
+        x2 = tf.maximum(tf.minimum(ctr_x + 0.5 * widths, max_x), 0.0)
+        y2 = tf.maximum(tf.minimum(pred_ctr_y + 0.5 * pred_h, max_y), 0.0)
+        proposals = tf.stack([x1, y1, x2, y2], axis=1)
+
+        # _filter_boxes, min_size is converted to the input image scale
+        keep = tf.reshape(tf.where(
+            (x2 - x1 + 1 >= min_size * im_info[2]) &
+            (y2 - y1 + 1 >= min_size * im_info[2])), [-1])
+        scores = tf.gather(scores, keep)
+
+        # top_k <= 0 keeps all proposals
+        num_proposals = tf.size(scores)
+        k = tf.where(top_k > 0, tf.minimum(top_k, num_proposals), num_proposals)
+        scores, order = tf.nn.top_k(scores, k=k, sorted=True)
+        order = tf.gather(keep, order)
+
+        return {'im_info': im_info,
+                'min_score': min_score,
+                'min_size': min_size,
+                'top_k': top_k,
+                'scores': tf.identity(scores, name='scores'),
+                'proposals': tf.gather(proposals, order, name='boxes'),
+                'bbox_deltas': tf.gather(bbox_deltas, order, name='bbox_deltas')}
+
+
+class CTPNModel(object):
+    """
+    Pre-trained CTPN model in a tensorflow session shared by all threads.
+
+    Input/output tensors are looked up once when the model is loaded,
+    and the number of forward passes running at the same time is limited,
+    so that concurrent requests queue up instead of oversubscribing the
+    cores (each forward pass already uses intra_op_threads threads).
+
+    With fused_proposals, the proposal decoding ops (add_proposal_ops) are
+    appended to the graph at load time, for predict_proposals.
+    """
+
+    def __init__(self,
+                 config_filepath: Text,
+                 model_filepath: Text,
+                 intra_op_threads: int = 0,
+                 inter_op_threads: int = 0,
+                 max_concurrent_runs: int = 1,
+                 fused_proposals: bool = False):
+        """
+        :param config_filepath: filepath to configuration yaml file
+        :param model_filepath: filepath to pre-trained model
+        :param intra_op_threads: threads used within an op, 0 lets tensorflow decide
+        :param inter_op_threads: ops run in parallel, 0 lets tensorflow decide
+        :param max_concurrent_runs: maximum number of forward passes in flight
+        :param fused_proposals: decode proposals in the graph (predict_proposals)
+        """
+        self.sess = create_tf_session(config_filepath=config_filepath,
+                                      model_filepath=model_filepath,
+                                      intra_op_threads=intra_op_threads,
+                                      inter_op_threads=inter_op_threads)
+
+        # Retrieve tensors from graph
+        self.input_img = self.sess.graph.get_tensor_by_name('Placeholder:0')
+        self.output_cls_prob = self.sess.graph.get_tensor_by_name('Reshape_2:0')
+        self.output_box_pred = self.sess.graph.get_tensor_by_name(
+            'rpn_bbox_pred/Reshape_1:0')
+
+        self.fused_proposals = fused_proposals
+        if fused_proposals:
+            with self.sess.graph.as_default():
+                self.proposal_ops = add_proposal_ops(self.output_cls_prob,
+                                                     self.output_box_pred,
+                                                     anchor_scales=cfg.ANCHOR_SCALES)
+
+        self._semaphore = threading.BoundedSemaphore(max_concurrent_runs)
+
+    @classmethod
+    def from_env(cls, config_filepath: Text, model_filepath: Text):
+        """
+        Load the model with thread settings from environment variables
+        """
+        return cls(config_filepath=config_filepath,
+                   model_filepath=model_filepath,
+                   intra_op_threads=int(os.environ.get('CTPN_INTRA_OP_THREADS', 0)),
+                   inter_op_threads=int(os.environ.get('CTPN_INTER_OP_THREADS', 0)),
+                   max_concurrent_runs=int(os.environ.get('CTPN_MAX_CONCURRENT_RUNS', 1)),
+                   fused_proposals=os.environ.get('CTPN_FUSED_PROPOSALS', '0') == '1')
+
+    def predict(self, blob: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        Run a forward pass and return the RPN outputs (cls_prob, box_pred),
+        waiting while max_concurrent_runs forward passes are in flight
+        :param blob: (N, H, W, 3) image blob
+        """
+        with self._semaphore:
+            return self.sess.run([self.output_cls_prob, self.output_box_pred],
+                                 feed_dict={self.input_img: blob})
+
+    def predict_proposals(self,
+                          blob: np.ndarray,
+                          im_info: np.ndarray,
+                          min_score: float = None,
+                          cfg_key: Text = 'TEST') -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Run a forward pass and decode the proposals in the graph, returning
+        (scores, proposals, bbox_deltas) of the top RPN_PRE_NMS_TOP_N
+        proposals by decreasing score, ready for nms_proposals.
+        Requires fused_proposals
+        :param blob: (1, H, W, 3) image blob
+        :param im_info: (1, 3) array of [image_height, image_width, scale_ratio]
+        :param min_score: if given, drop proposals scoring min_score or less
+        :param cfg_key: 'TEST' or 'TRAIN' config for the size filter and top-k
+        """
+        ops = self.proposal_ops
+        feed_dict = {self.input_img: blob,
+                     ops['im_info']: im_info[0],
+                     ops['min_size']: cfg[cfg_key].RPN_MIN_SIZE,
+                     ops['top_k']: cfg[cfg_key].RPN_PRE_NMS_TOP_N}
+        if min_score is not None:
+            feed_dict[ops['min_score']] = min_score
+
+        with self._semaphore:
+            return self.sess.run([ops['scores'], ops['proposals'], ops['bbox_deltas']],
+                                 feed_dict=feed_dict)
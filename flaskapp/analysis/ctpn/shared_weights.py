@@ -0,0 +1,122 @@
+"""
+Share the CTPN weights between processes through memory-mapped files.
+
+The frozen graph (ctpn.pb) embeds the VGG weights in Const nodes, so every
+process that parses it holds its own copy of the weights. convert_graph
+writes each large constant to its own file and replaces the Const node by
+an ImmutableConst node, which makes tensorflow mmap the file read-only
+instead of copying the weights. All processes loading the converted graph
+then share the same physical pages (the page cache of the weight files).
+
+Usage (run as a script, as importing the flaskapp package loads the
+engines, i.e. the very graph to convert):
+    python flaskapp/analysis/ctpn/shared_weights.py ctpn.pb weights_dir
+"""
+
+from typing import Text
+import os
+import re
+import shutil
+import sys
+
+import numpy as np
+
+GRAPH_FILENAME = 'graph.pb'
+
+# keep the mappings of the master alive, so that workers forked from it
+# find the pages already loaded
+_mapped = []
+
+
+def convert_graph(model_filepath: Text,
+                  weights_dir: Text,
+                  min_bytes: int = 1024) -> Text:
+    """
+    Convert a frozen graph so that its constants are memory-mapped from
+    files in weights_dir, and return the filepath of the converted graph.
+    The directory is created atomically, so concurrent conversions from
+    several processes are safe. Raises OSError if weights_dir exists
+    but does not hold a converted graph.
+    :param model_filepath: filepath to the frozen graph
+    :param weights_dir: directory to write the converted graph/weights to
+    :param min_bytes: constants smaller than this are kept in the graph
+    """
+    # tensorflow is only needed to convert, not to share weights
+    import tensorflow as tf
+    from tensorflow.python.framework import tensor_util
+
+    weights_dir = os.path.abspath(weights_dir)
+    tmp_dir = '{}.tmp-{}'.format(weights_dir, os.getpid())
+    os.makedirs(tmp_dir)
+
+    graph_def = tf.GraphDef()
+    with open(model_filepath, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    for index, node in enumerate(graph_def.node):
+        if node.op != 'Const':
+            continue
+        array = tensor_util.MakeNdarray(node.attr['value'].tensor)
+        if array.dtype == np.object_ or array.nbytes < min_bytes:
+            continue
+
+        filename = '{}_{}.bin'.format(index, re.sub('[^A-Za-z0-9_.-]', '_', node.name))
+        np.ascontiguousarray(array).tofile(os.path.join(tmp_dir, filename))
+
+        # ImmutableConst takes the same dtype attribute as Const
+        shape = node.attr['value'].tensor.tensor_shape
+        node.op = 'ImmutableConst'
+        del node.attr['value']
+        node.attr['shape'].shape.CopyFrom(shape)
+        node.attr['memory_region_name'].s = os.path.join(weights_dir, filename).encode()
+
+    with open(os.path.join(tmp_dir, GRAPH_FILENAME), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    graph_filepath = os.path.join(weights_dir, GRAPH_FILENAME)
+    try:
+        os.rename(tmp_dir, weights_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)
+        # fine if converted by another process in the meantime, otherwise
+        # weights_dir is in the way (e.g. a non-empty, unrelated directory)
+        if not os.path.exists(graph_filepath):
+            raise
+
+    return graph_filepath
+
+
+def ensure_converted(model_filepath: Text, weights_dir: Text) -> Text:
+    """
+    Return the filepath of the converted graph in weights_dir,
+    converting model_filepath first if necessary
+    """
+    graph_filepath = os.path.join(weights_dir, GRAPH_FILENAME)
+    if not os.path.exists(graph_filepath):
+        graph_filepath = convert_graph(model_filepath, weights_dir)
+    return graph_filepath
+
+
+def map_weights(weights_dir: Text) -> int:
+    """
+    Memory-map all weight files in weights_dir and read one byte per page,
+    so that the weights are loaded once (e.g. in the gunicorn master)
+    before workers map the same pages. Returns the number of bytes mapped.
+    """
+    total = 0
+    for filename in sorted(os.listdir(weights_dir)):
+        if not filename.endswith('.bin'):
+            continue
+        weights = np.memmap(os.path.join(weights_dir, filename),
+                            dtype=np.uint8, mode='r')
+        weights[::4096].sum()
+        _mapped.append(weights)
+        total += weights.size
+    return total
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    print(convert_graph(model_filepath=sys.argv[1], weights_dir=sys.argv[2]))
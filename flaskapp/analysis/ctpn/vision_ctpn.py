@@ -2,53 +2,28 @@ from typing import Text, List
 
 import cv2
 import numpy as np
-import tensorflow as tf
-from tensorflow.python.platform import gfile
 
-from lib.fast_rcnn.config import cfg, cfg_from_file
-from lib.fast_rcnn.test import _get_blobs
+from lib.fast_rcnn.config import cfg
+from lib.fast_rcnn.test import _get_blobs, _get_image_scale
 from lib.text_connector.detectors import TextDetector
 from lib.text_connector.text_connect_cfg import Config as TextLineCfg
-from lib.rpn_msr.proposal_layer_tf import proposal_layer
+from lib.rpn_msr.proposal_layer_tf import proposal_layer, nms_proposals
 
+from flaskapp.analysis.ctpn.batcher import CTPNBatcher
+from flaskapp.analysis.ctpn.model import CTPNModel
 from flaskapp.analysis.utils.box import Box, merge_boxes
-from flaskapp.analysis.utils.deskew import skew_angle, rotate
-from flaskapp.analysis.pytesseract.vision_pytesseract import ocr
+from flaskapp.analysis.utils.pyramid import ImagePyramid
+from flaskapp.analysis.utils.deskew import estimate_skew, rotation_matrix, rotate_points, \
+    MIN_ROTATION_DEGREES, MIN_SKEW_CONFIDENCE, DESKEW_MODE
+from flaskapp.analysis.pytesseract.vision_pytesseract import ocr_batch, OCR_SCALE
 
 
-def resize_im(im: np.ndarray,
-              scale: int,
-              max_scale: int = None) -> (np.ndarray, float):
+def regions_of_interest(img_shape: tuple,
+                        boxes: np.ndarray) -> List[Box]:
     """
-    Resize an image according to given scale. Scale will be
-    adjusted depending on original image size and max_scale allowed.
-
-    Returns the resized image, with the final scale applied
-    (not necessary to return scale unless we intend to resize
-    image back to original scale)
-
-    :param im: image to be resized
-    :param scale: scaling factor to be applied
-    :param max_scale: maximum scale to be applied
-    """
-
-    # find appropriate scale relative to original image size
-    f = float(scale) / min(im.shape[0], im.shape[1])
-
-    if max_scale and f * max(im.shape[0], im.shape[1]) > max_scale:
-        f = float(max_scale) / max(im.shape[0], im.shape[1])
-
-    return cv2.resize(im, None, None, fx=f, fy=f,
-                      interpolation=cv2.INTER_LINEAR), f
-
-
-def draw_boxes(img: np.ndarray,
-               boxes: np.ndarray) -> List[np.ndarray]:
-    """
-    Given an image, extract regions of interest indicated
-    by the boxes and crop them from the image. Returns a
-    list of cropped images representing the ROIs
-    :param img: image to extract boxes from
+    Given the boxes detected in an image, merge nearby boxes into
+    regions of interest, padded and clipped to the image
+    :param img_shape: shape of the image the boxes were detected in
     :param boxes: array of boxes where each box is an array of float.
                   each box contains the coordinates of its vertices and (?)
     """
@@ -65,96 +40,179 @@ def draw_boxes(img: np.ndarray,
         custombox = Box(x, y, w, h)
         to_merge.append(custombox)
 
-    vertical_threshold = round(img.shape[0] * 0.05)
-    horizontal_threshold = round(img.shape[1] * 0.05)
+    vertical_threshold = round(img_shape[0] * 0.05)
+    horizontal_threshold = round(img_shape[1] * 0.05)
     merged_boxes = merge_boxes(to_merge,
                                v_thresh=vertical_threshold,
                                h_thresh=horizontal_threshold)
 
-    cropped_images = []
-    for custombox in merged_boxes:
-        custombox = custombox.scale(fx=1.15, fy=1.15, max_height=img.shape[0],
-                                    max_width=img.shape[1])
-        cropped = img[
-                  custombox.top_left_y:custombox.top_left_y + custombox.height,
-                  custombox.top_left_x:custombox.top_left_x + custombox.width]
-        cropped_images.append(cropped)
+    return [custombox.scale(fx=1.15, fy=1.15, max_height=img_shape[0],
+                            max_width=img_shape[1])
+            for custombox in merged_boxes]
 
-    return cropped_images
 
-
-def create_tf_session(config_filepath: Text = './text.yml',
-                      model_filepath: Text = './ctpn.pb') -> tf.Session:
+def rotate_boxes(boxes: np.ndarray,
+                 img_shape: tuple,
+                 degrees: float) -> (np.ndarray, tuple):
     """
-    Initialise a tensorflow session with given config/model
-    :param config_filepath: filepath to configuration yaml file
-    :param model_filepath: filepath to pre-trained model
+    Map the boxes detected in an image into the coordinates of that
+    image rotated counter-clockwise by degrees (as rotate() would),
+    as axis-aligned boxes. Returns the boxes and the shape of the
+    rotated image
+    :param boxes: array of boxes, as returned by TextDetector
+    :param img_shape: shape of the image the boxes were detected in
+    :param degrees: skew angle of the image
     """
-    # merge YAML config into default options __C (easydict)
-    cfg_from_file(config_filepath)
-
-    # Initialize a session with allow_soft_placement set to True.
-    config = tf.ConfigProto(allow_soft_placement=True)
-    sess = tf.Session(config=config)
-
-    with gfile.FastGFile(model_filepath, 'rb') as f:
-        # Initialize graph object
-        graph_def = tf.GraphDef()
-
-        # Read graph from file
-        graph_def.ParseFromString(f.read())
-
-        # Redundant? sets session to run with default graph?
-        sess.graph.as_default()
-
-        # Import the graph from graph_def into current default graph
-        tf.import_graph_def(graph_def, name='')
+    mat, (width, height) = rotation_matrix(img_shape, degrees)
+    corners = rotate_points(boxes[:, :8].reshape(-1, 2), mat).reshape(-1, 4, 2)
+    top_left = corners.min(axis=1)
+    bottom_right = corners.max(axis=1)
+
+    if cfg.TEST.DETECT_MODE == 'H':
+        # horizontal boxes enclose text lines skewed by degrees: recover
+        # the length and thickness of the lines, which are horizontal
+        # once rotated, about the center of their box
+        r = np.deg2rad(abs(degrees))
+        w = boxes[:, 2] - boxes[:, 0]
+        h = boxes[:, 5] - boxes[:, 1]
+        length = (w * np.cos(r) - h * np.sin(r)) / np.cos(2 * r)
+        thickness = (h * np.cos(r) - w * np.sin(r)) / np.cos(2 * r)
+        # lines less skewed than the image keep their rotated box
+        fits = (length > 0) & (thickness > 0)
+        center = corners.mean(axis=1)
+        half = np.stack((length, thickness), axis=1)[fits] / 2
+        top_left[fits] = center[fits] - half
+        bottom_right[fits] = center[fits] + half
+
+    rotated = boxes.copy()
+    rotated[:, [0, 4]] = top_left[:, [0]]
+    rotated[:, [2, 6]] = bottom_right[:, [0]]
+    rotated[:, [1, 3]] = top_left[:, [1]]
+    rotated[:, [5, 7]] = bottom_right[:, [1]]
+    return rotated, (height, width) + tuple(img_shape[2:])
+
+
+def detection_level(pyramid: ImagePyramid,
+                    degrees: float = 0.0) -> (np.ndarray, float):
+    """
+    Return the image CTPN runs on, i.e. a level of the pyramid rotated
+    counter-clockwise by degrees, and the scale of that level. It is sized
+    by the rules _get_image_blob applies (cfg.TEST.SCALES, cfg.TEST.MAX_SIZE)
+    to the rotated image, so that the blob is built from it as is
+    :param pyramid: pyramid of the uploaded image
+    :param degrees: angle to rotate the level by, if any
+    """
+    height, width = pyramid.shape[:2]
+    if degrees:
+        _, (width, height) = rotation_matrix(pyramid.shape, degrees)
+    scale = _get_image_scale((height, width), cfg.TEST.SCALES[0])
+    img = pyramid.level(scale)
+    if not degrees:
+        return img, scale
+
+    # rotate about the center, into a canvas of the final size (rounding
+    # may leave the rotated level a pixel off it, the blob would be resized)
+    size = (int(round(width * scale)), int(round(height * scale)))
+    mat = cv2.getRotationMatrix2D(center=(img.shape[1] / 2, img.shape[0] / 2),
+                                  angle=degrees,
+                                  scale=1.0)
+    mat[0, 2] += (size[0] - img.shape[1]) / 2
+    mat[1, 2] += (size[1] - img.shape[0]) / 2
+    return cv2.warpAffine(img, mat, dsize=size), scale
+
+
+def crop_regions(img: np.ndarray,
+                 regions: List[Box],
+                 scale: float = 1.0,
+                 degrees: float = 0.0) -> List[np.ndarray]:
+    """
+    Crop regions of interest from an image. Returns a list of
+    cropped images representing the ROIs
+    :param img: image to crop regions from
+    :param regions: regions, in coordinates of an image scale times
+                    smaller than img (e.g. another level of its pyramid)
+    :param scale: scale of img relative to the image of the regions
+    :param degrees: if not 0, regions are in coordinates of img rotated
+                    by degrees (see rotate_boxes and detection_level):
+                    only the regions are warped, instead of the whole image
+    """
+    if degrees:
+        mat, _ = rotation_matrix(img.shape, degrees)
 
-        # Initialise ALL variables to hold specific values, and run the session
-        # variables are added to GLOBAL_VARIABLES collection by default
-        sess.run(tf.global_variables_initializer())
+    cropped_images = []
+    for custombox in regions:
+        x, y, w, h = np.round(ImagePyramid.transform(
+            [custombox.top_left_x, custombox.top_left_y,
+             custombox.width, custombox.height], 1.0, scale)).astype(int)
+        if degrees:
+            # translate the rotated image so that the region is at the origin
+            roi_mat = mat.copy()
+            roi_mat[:, 2] -= (x, y)
+            cropped_images.append(cv2.warpAffine(img, roi_mat, dsize=(int(w), int(h))))
+        else:
+            cropped_images.append(img[y:y + h, x:x + w])
 
-    return sess
+    return cropped_images
 
 
-from datetime import datetime
 def detect_text_ctpn(image_bytes: bytes,
-                     sess: tf.Session) -> (np.ndarray, np.ndarray, float):
+                     model: CTPNModel,
+                     batcher: CTPNBatcher = None) -> List[Text]:
     """
-    Given an image and an active tensorflow session loaded with config/model,
+    Given an image and a CTPN model loaded with config/model,
     run the model to identify regions of interest (i.e. regions that are
     likely to contain text).
 
     :param image_bytes: image to detect text/perform ocr on
-    :param sess: active tensorflow session with graph and config loaded
+    :param model: CTPN model with graph and config loaded
+    :param batcher: if given, run the model through the batcher so that
+                    concurrent requests share forward passes
     """
 
     # TODO: Read more about this section, up to TextDetector()
-    # Retrieve tensors from graph
-    input_img = sess.graph.get_tensor_by_name('Placeholder:0')
-    output_cls_prob = sess.graph.get_tensor_by_name('Reshape_2:0')
-    output_box_pred = sess.graph.get_tensor_by_name(
-        'rpn_bbox_pred/Reshape_1:0')
-
     # Process image
-    img_array = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(img_array, cv2.IMREAD_ANYCOLOR)
-    img, scale = resize_im(img, scale=TextLineCfg.SCALE,
-                           max_scale=TextLineCfg.MAX_SCALE)
-    img = rotate(img, skew_angle(image=img))
+    # the image is decoded once (large JPEGs at reduced resolution), with
+    # enough resolution left for ocr; detection runs on a smaller level
+    pyramid = ImagePyramid.decode(image_bytes,
+                                  scale=cfg.TEST.SCALES[0] * OCR_SCALE,
+                                  max_scale=cfg.TEST.MAX_SIZE * OCR_SCALE)
+    img, detection_scale = detection_level(pyramid)
+    # most uploads are straight, only rotate for a confident, large enough angle
+    angle, confidence = estimate_skew(img)
+    deskew_angle = 0.0
+    if confidence >= MIN_SKEW_CONFIDENCE and abs(angle) >= MIN_ROTATION_DEGREES:
+        # in either mode only the regions passed to ocr are warped from
+        # the (larger) ocr level, see crop_regions
+        deskew_angle = angle
+        if DESKEW_MODE != 'boxes':
+            # detect on the rotated detection level, sized for the blob
+            img, detection_scale = detection_level(pyramid, angle)
 
     blobs, im_scales = _get_blobs(img, None)
+    # the detection level is already at the blob size, never resized twice
+    assert im_scales[0] == 1.0, 'CTPN input resized: {}'.format(im_scales[0])
     if cfg.TEST.HAS_RPN:
         im_blob = blobs['data']
         blobs['im_info'] = np.array(
             [[im_blob.shape[1], im_blob.shape[2], im_scales[0]]],
             dtype=np.float32)
 
-    cls_prob, box_pred = sess.run([output_cls_prob, output_box_pred],
-                                  feed_dict={input_img: blobs['data']})
-
-    rois, _ = proposal_layer(cls_prob, box_pred, blobs['im_info'], 'TEST',
-                             anchor_scales=cfg.ANCHOR_SCALES)
+    if batcher is None and model.fused_proposals:
+        # proposals are decoded in the graph, only NMS is left
+        scores, proposals, bbox_deltas = model.predict_proposals(
+            blobs['data'], blobs['im_info'],
+            min_score=TextLineCfg.TEXT_PROPOSALS_MIN_SCORE)
+        rois, _ = nms_proposals(proposals, scores[:, np.newaxis],
+                                bbox_deltas, 'TEST')
+    else:
+        predictor = batcher if batcher is not None else model
+        cls_prob, box_pred = predictor.predict(blobs['data'])
+
+        # proposals scoring TEXT_PROPOSALS_MIN_SCORE or less are dropped
+        # by TextDetector anyway, so they are not even decoded
+        rois, _ = proposal_layer(cls_prob, box_pred, blobs['im_info'], 'TEST',
+                                 anchor_scales=cfg.ANCHOR_SCALES,
+                                 min_score=TextLineCfg.TEXT_PROPOSALS_MIN_SCORE)
 
     scores = rois[:, 0]
     boxes = rois[:, 1:5] / im_scales[0]
@@ -164,13 +222,20 @@ def detect_text_ctpn(image_bytes: bytes,
     boxes = textdetector.detect(boxes, scores[:, np.newaxis],
                                 img.shape[:2])
 
-    # crop regions of interest indicated by boxes
-    cropped_images = draw_boxes(img, boxes)
-
-    # for each region of interest, perform ocr
-    mystrings = []
-    for cropped in cropped_images:
-        mystrings.append(ocr(cropped))
-
-    # return collection of text extracted from the image
-    return mystrings
+    # crop regions of interest indicated by boxes from the level at
+    # OCR_SCALE times the detection resolution (or the sharpest one),
+    # rather than upscaling crops of the detection level
+    img_shape = img.shape
+    if deskew_angle and DESKEW_MODE == 'boxes':
+        # boxes detected on the skewed image
+        boxes, img_shape = rotate_boxes(boxes, img.shape, deskew_angle)
+    regions = regions_of_interest(img_shape, boxes)
+    ocr_scale = min(detection_scale * OCR_SCALE, 1.0)
+    cropped_images = crop_regions(pyramid.level(ocr_scale), regions,
+                                  scale=ocr_scale / detection_scale,
+                                  degrees=deskew_angle)
+
+    # perform ocr on all regions of interest in one engine session
+    # and return collection of text extracted from the image
+    return ocr_batch(cropped_images,
+                     scale=detection_scale * OCR_SCALE / ocr_scale)
@@ -0,0 +1,132 @@
+"""Process-wide pool of google cloud vision clients sharing gRPC channels."""
+
+from typing import Text
+from contextlib import contextmanager
+import os
+import threading
+
+import grpc
+from google.api_core import grpc_helpers
+from google.cloud import vision_v1p3beta1 as vision  # beta version
+from google.cloud.vision_v1p3beta1.gapic.transports.image_annotator_grpc_transport import \
+    ImageAnnotatorGrpcTransport
+
+DEFAULT_ADDRESS = 'vision.googleapis.com:443'
+
+
+class VisionClientPool(object):
+    """
+    Pool of ImageAnnotatorClients, each with its own long-lived gRPC
+    channel, so that credentials, channels and TLS sessions are reused
+    across requests instead of being created for every image.
+
+    Clients are created lazily on first use, and again whenever the pool
+    is used from a new process: gRPC channels must not be shared across
+    a fork, so each gunicorn worker builds its own clients after forking.
+    """
+
+    def __init__(self,
+                 size: int = 1,
+                 max_concurrency: int = 8,
+                 endpoint: Text = None,
+                 keepalive_ms: int = 30000):
+        """
+        :param size: number of clients (gRPC channels) in the pool
+        :param max_concurrency: maximum number of requests in flight
+        :param endpoint: host:port of a plaintext endpoint (e.g. a local
+                         fake server). Defaults to the google api over TLS
+        :param keepalive_ms: interval between keepalive pings on idle channels
+        """
+        self.size = size
+        self.max_concurrency = max_concurrency
+        self.endpoint = endpoint
+        self.keepalive_ms = keepalive_ms
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._clients = []
+        self._channels = []
+        self._next = 0
+        self._semaphore = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        Configure the pool from environment variables
+        """
+        return cls(size=int(os.environ.get('GCP_VISION_CHANNELS', 1)),
+                   max_concurrency=int(os.environ.get('GCP_VISION_MAX_CONCURRENCY', 8)),
+                   endpoint=os.environ.get('GCP_VISION_ENDPOINT') or None,
+                   keepalive_ms=int(os.environ.get('GCP_VISION_KEEPALIVE_MS', 30000)))
+
+    @property
+    def channel_options(self):
+        return [('grpc.keepalive_time_ms', self.keepalive_ms),
+                ('grpc.keepalive_timeout_ms', 10000),
+                ('grpc.keepalive_permit_without_calls', 1),
+                ('grpc.http2.max_pings_without_data', 0),
+                ('grpc.max_send_message_length', -1),
+                ('grpc.max_receive_message_length', -1)]
+
+    def _create_channel(self) -> grpc.Channel:
+        if self.endpoint:
+            return grpc.insecure_channel(self.endpoint,
+                                         options=self.channel_options)
+        # grpc_helpers passes options through to grpc.secure_channel, with
+        # the default credentials (the transport's create_channel does not)
+        return grpc_helpers.create_channel(
+            DEFAULT_ADDRESS,
+            scopes=ImageAnnotatorGrpcTransport._OAUTH_SCOPES,
+            options=self.channel_options)
+
+    def _ensure_clients(self):
+        """
+        Create clients for the current process if they do not exist yet
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            # channels inherited from a parent process are unusable,
+            # drop them without closing (closing would affect the parent)
+            self._channels = [self._create_channel() for _ in range(self.size)]
+            self._clients = [
+                vision.ImageAnnotatorClient(
+                    transport=ImageAnnotatorGrpcTransport(channel=channel))
+                for channel in self._channels]
+            self._next = 0
+            self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+            self._pid = os.getpid()
+
+    @contextmanager
+    def client(self):
+        """
+        Borrow a client from the pool (round robin), waiting while
+        max_concurrency requests are already in flight.
+
+        with pool.client() as client:
+            client.document_text_detection(...)
+        """
+        self._ensure_clients()
+
+        semaphore = self._semaphore
+        semaphore.acquire()
+        try:
+            with self._lock:
+                client = self._clients[self._next % len(self._clients)]
+                self._next += 1
+            yield client
+        finally:
+            semaphore.release()
+
+    def close(self):
+        """
+        Close all channels opened by the current process
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                for channel in self._channels:
+                    channel.close()
+            self._channels = []
+            self._clients = []
+            self._pid = None
@@ -1,26 +1,30 @@
-from typing import List, Text
+from typing import List, Optional, Text
+import os
 
 from google.cloud import vision_v1p3beta1 as vision  # beta version
 
+from flaskapp.analysis.gcp.client_pool import VisionClientPool
 
-def detect_text_gcp(image_bytes: bytes) -> List[Text]:
-    """
-    Given an image in bytes, recognize text
-    in the image and return it as a list of text chunks
-    :param image_bytes: image in bytes to perform OCR on
-    """
-
-    client = vision.ImageAnnotatorClient()
+# clients are shared by all requests of a process, see VisionClientPool
+client_pool = VisionClientPool.from_env()
 
-    image = vision.types.Image(content=image_bytes)
+# maximum number of images sent in one batch_annotate_images request
+GCP_BATCH_SIZE = int(os.environ.get('GCP_BATCH_SIZE', 16))
 
-    image_context = vision.types.ImageContext(language_hints=['en'])
+LANGUAGE_HINTS = ['en']
+# description of everything that affects the text returned for an image
+GCP_CONFIG = '{} document_text_detection language_hints={}'.format(
+    vision.__name__, ','.join(LANGUAGE_HINTS))
 
-    response = client.document_text_detection(image=image,
-                                              image_context=image_context)
 
+def extract_text_chunks(annotation) -> List[Text]:
+    """
+    Given a full text annotation returned by google cloud vision,
+    join the symbols of each paragraph into a chunk of text
+    :param annotation: vision.types.TextAnnotation
+    """
     text_chunks = []
-    for page in response.full_text_annotation.pages:
+    for page in annotation.pages:
         for block in page.blocks:
             for paragraph in block.paragraphs:
                 chunk = ''
@@ -30,3 +34,57 @@ def detect_text_gcp(image_bytes: bytes) -> List[Text]:
                 text_chunks.append(chunk)
 
     return text_chunks
+
+
+def detect_text_gcp(image_bytes: bytes) -> List[Text]:
+    """
+    Given an image in bytes, recognize text
+    in the image and return it as a list of text chunks
+    :param image_bytes: image in bytes to perform OCR on
+    """
+
+    image = vision.types.Image(content=image_bytes)
+
+    image_context = vision.types.ImageContext(language_hints=LANGUAGE_HINTS)
+
+    with client_pool.client() as client:
+        response = client.document_text_detection(image=image,
+                                                  image_context=image_context)
+
+    return extract_text_chunks(response.full_text_annotation)
+
+
+def detect_text_gcp_batch(images_bytes: List[bytes]) -> List[Optional[List[Text]]]:
+    """
+    Given several images in bytes, recognize text in all of them
+    using as few requests as possible (up to GCP_BATCH_SIZE images
+    per request), and return a list of text chunks for each image,
+    in the same order as images_bytes. Images that could not be
+    annotated (the response for the image holds an error) yield None.
+    :param images_bytes: images in bytes to perform OCR on
+    """
+
+    image_context = vision.types.ImageContext(language_hints=LANGUAGE_HINTS)
+    features = [vision.types.Feature(
+        type=vision.enums.Feature.Type.DOCUMENT_TEXT_DETECTION)]
+
+    text_chunks = []
+    for start in range(0, len(images_bytes), GCP_BATCH_SIZE):
+        requests = [vision.types.AnnotateImageRequest(
+                        image=vision.types.Image(content=image_bytes),
+                        features=features,
+                        image_context=image_context)
+                    for image_bytes in images_bytes[start:start + GCP_BATCH_SIZE]]
+
+        with client_pool.client() as client:
+            response = client.batch_annotate_images(requests)
+
+        for image_response in response.responses:
+            if image_response.error.code:
+                # e.g. an image that could not be decoded
+                text_chunks.append(None)
+            else:
+                text_chunks.append(
+                    extract_text_chunks(image_response.full_text_annotation))
+
+    return text_chunks
@@ -0,0 +1,159 @@
+"""Bounded pool of long-lived, in-process tesseract engines."""
+
+from contextlib import contextmanager
+from typing import Dict, List, Text
+import threading
+
+import numpy as np
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+class TesseractPool(object):
+    """
+    Keeps up to size tesserocr API handles, so the tesseract model is
+    loaded once per handle instead of once per image. Images are
+    passed to the engine as raw numpy buffers, without touching disk.
+
+    tesserocr handles are not thread-safe: a thread checks a handle out
+    for the duration of a recognition and checks it back in afterwards,
+    waiting for one to be returned when all handles are in use. Handles
+    are created on first use, so that a process that never runs OCR
+    does not load tesseract.
+    """
+
+    def __init__(self,
+                 tessdata_dir: Text,
+                 lang: Text,
+                 oem: int,
+                 psm: int,
+                 variables: Dict[Text, Text] = None,
+                 size: int = 4):
+        """
+        :param tessdata_dir: directory containing the .traineddata files
+        :param lang: language(s) to load, e.g. 'eng'
+        :param oem: OCR engine mode (same values as tesseract --oem)
+        :param psm: page segmentation mode (same values as tesseract --psm)
+        :param variables: tesseract variables to set on every handle
+        :param size: maximum number of handles
+        """
+        self.tessdata_dir = tessdata_dir
+        self.lang = lang
+        self.oem = oem
+        self.psm = psm
+        self.variables = variables or {}
+        self.size = max(1, size)
+
+        # idle handles, most recently used last; the condition is notified
+        # when a handle is checked in or fails to be created
+        self._idle = []
+        self._cond = threading.Condition()
+        self._created = 0
+        self._failed = False
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether in-process recognition can be used, i.e. tesserocr is
+        installed and no engine failed to initialise before
+        """
+        return tesserocr is not None and not self._failed
+
+    def _create_api(self):
+        # tesserocr expects the tessdata path to end with a separator
+        path = self.tessdata_dir.rstrip('/') + '/'
+        try:
+            api = tesserocr.PyTessBaseAPI(path=path,
+                                          lang=self.lang,
+                                          oem=self.oem,
+                                          psm=self.psm)
+        except RuntimeError:
+            # e.g. missing traineddata, do not try again on every call
+            self._failed = True
+            raise
+
+        for name, value in self.variables.items():
+            api.SetVariable(name, value)
+
+        return api
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._failed:
+                    # callers fall back to the tesseract binary
+                    raise RuntimeError('tesseract engine could not be initialised')
+                if self._created < self.size:
+                    self._created += 1
+                    break
+                # all handles are in use, wait for a checkin or a failure
+                self._cond.wait()
+
+        try:
+            return self._create_api()
+        except Exception:
+            # free the slot, and wake up waiters to retry (or give up)
+            with self._cond:
+                self._created -= 1
+                self._cond.notify_all()
+            raise
+
+    @contextmanager
+    def checkout(self):
+        """
+        Check a tesseract handle out of the pool for the duration of
+        the with block, creating it if fewer than size handles exist
+        """
+        api = self._acquire()
+        try:
+            yield api
+        finally:
+            with self._cond:
+                self._idle.append(api)
+                self._cond.notify()
+
+    @staticmethod
+    def _recognise(api, image: np.ndarray) -> Text:
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+
+        api.SetImageBytes(image.tobytes(), width, height,
+                          bytes_per_pixel, width * bytes_per_pixel)
+        try:
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+
+    def recognise(self, image: np.ndarray) -> Text:
+        """
+        Run tesseract on an 8-bit grayscale or BGR image and return
+        the recognised text
+        :param image: image as a numpy array of dtype uint8
+        """
+        with self.checkout() as api:
+            return self._recognise(api, image)
+
+    def recognise_all(self, images: List[np.ndarray]) -> List[Text]:
+        """
+        Run tesseract on several images with a single handle,
+        checked out once for all of them
+        :param images: images as numpy arrays of dtype uint8
+        """
+        with self.checkout() as api:
+            return [self._recognise(api, image) for image in images]
+
+    def close(self):
+        """
+        Release the tesseract handles that are not checked out
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+        for api in idle:
+            api.End()
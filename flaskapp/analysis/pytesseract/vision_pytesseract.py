@@ -1,10 +1,56 @@
-from typing import Text, List
+from typing import Text, List, Optional
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import functools
 import os
 import tempfile
+import threading
 
 import cv2
 import numpy as np
 import pytesseract
+from PIL import Image
+
+from flaskapp.analysis.pytesseract.tesseract_pool import TesseractPool
+
+TESSDATA_DIR = './tessdata'
+TESSERACT_LANG = 'eng'
+TESSERACT_OEM = 0
+TESSERACT_PSM = 1
+CHAR_WHITELIST = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789<'
+TESSERACT_CONFIG = '--tessdata-dir {} --oem {} --psm {} -c tessedit_char_whitelist="{}"'.format(
+    TESSDATA_DIR, TESSERACT_OEM, TESSERACT_PSM, CHAR_WHITELIST)
+
+# Set TESSERACT_IN_PROCESS=0 to always shell out to the tesseract binary
+IN_PROCESS = os.environ.get('TESSERACT_IN_PROCESS', '1') != '0'
+
+# Maximum number of in-process tesseract engines per process
+TESSERACT_POOL_SIZE = int(os.environ.get('TESSERACT_POOL_SIZE', min(4, os.cpu_count() or 1)))
+
+tesseract_pool = TesseractPool(tessdata_dir=TESSDATA_DIR,
+                               lang=TESSERACT_LANG,
+                               oem=TESSERACT_OEM,
+                               psm=TESSERACT_PSM,
+                               variables={'tessedit_char_whitelist': CHAR_WHITELIST},
+                               size=TESSERACT_POOL_SIZE)
+
+# how images are recognised: in-process tesserocr engines or the tesseract
+# binary, which may not return the same text for the same image
+TESSERACT_BACKEND = 'tesserocr' if IN_PROCESS and tesseract_pool.available else 'binary'
+
+# white space between regions when tiling them into a single page
+TILE_GAP = 32
+
+# regions are upscaled by this factor before ocr
+OCR_SCALE = 1.2
+
+# Executor used to recognise the regions of a document in parallel:
+# 'thread' (tesserocr releases the GIL while recognising), 'process' or 'serial'
+OCR_EXECUTOR = os.environ.get('OCR_EXECUTOR', 'thread')
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', min(4, os.cpu_count() or 1)))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
 
 
 def run_tesseract_wrapper(input_filename: Text,
@@ -36,14 +82,48 @@ def run_tesseract_wrapper(input_filename: Text,
             return output_text
 
 
-def ocr(image: np.ndarray) -> Text:
+def recognise_subprocess(image: np.ndarray) -> Text:
     """
-    Function to compine all processing methods together into
-    a single function for ocr.
+    Fallback recognition path: save the image as a temp file
+    and call the tesseract binary on it.
+    """
+    with tempfile.NamedTemporaryFile(mode='w+', dir=os.getcwd(),
+                                     suffix='.jpg') as image_file:
+        cv2.imwrite(image_file.name, image)
+        return run_tesseract_wrapper(
+            input_filename=image_file.name,
+            extension='txt',
+            lang=TESSERACT_LANG,
+            config=TESSERACT_CONFIG)
+
+
+def recognise(image: np.ndarray) -> Text:
+    """
+    Run tesseract on a preprocessed image, using a pooled in-process
+    engine when available and the tesseract binary otherwise.
+    """
+    if IN_PROCESS and tesseract_pool.available:
+        try:
+            return tesseract_pool.recognise(image)
+        except RuntimeError:
+            # engine could not be initialised, fall back to the binary
+            pass
+    return recognise_subprocess(image)
+
+
+def preprocess(image: np.ndarray, scale: float = OCR_SCALE) -> np.ndarray:
+    """
+    Scale, sharpen and convert an image to grayscale before ocr
+    :param image: image to be processed
+    :param scale: scaling factor, 1 if the image was already cut from
+                  a level of the resolution wanted for ocr
     """
     # scale image
-    large = cv2.resize(image, None, None, fx=1.2, fy=1.2,
-                       interpolation=cv2.INTER_LINEAR)
+    if scale != 1.0:
+        large = cv2.resize(image, None, None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_LINEAR)
+    else:
+        large = image
 
     # sharpen image
     sharp = cv2.filter2D(large, -1,
@@ -52,18 +132,122 @@ def ocr(image: np.ndarray) -> Text:
                                    [-1 / 8, -1 / 8, -1 / 8]]))
 
     # convert to grayscale
-    gray = cv2.cvtColor(sharp, cv2.COLOR_BGR2GRAY)
+    return cv2.cvtColor(sharp, cv2.COLOR_BGR2GRAY)
 
-    # save image as temp file and call tesseract
-    with tempfile.NamedTemporaryFile(mode='w+', dir=os.getcwd(),
-                                     suffix='.jpg') as image:
-        cv2.imwrite(image.name, gray)
-        return run_tesseract_wrapper(
-            input_filename=image.name,
-            extension='txt',
-            lang='eng',
-            config='--tessdata-dir ./tessdata --oem 0 --psm 1 -c \
-                    tessedit_char_whitelist="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789<"')
+
+def ocr(image: np.ndarray) -> Text:
+    """
+    Function to compine all processing methods together into
+    a single function for ocr.
+    """
+    return recognise(preprocess(image))
+
+
+def tile_images(images: List[np.ndarray]) -> (np.ndarray, np.ndarray):
+    """
+    Stack grayscale images vertically into a single white page,
+    separated by TILE_GAP pixels. Returns the page and the
+    y offset at which each image starts.
+    """
+    width = max(image.shape[1] for image in images)
+    offsets = np.cumsum([0] + [image.shape[0] + TILE_GAP for image in images])
+    page = np.full((offsets[-1], width), 255, dtype=np.uint8)
+    for image, offset in zip(images, offsets):
+        page[offset:offset + image.shape[0], :image.shape[1]] = image
+    return page, offsets[:-1]
+
+
+def recognise_tiled(images: List[np.ndarray]) -> List[Text]:
+    """
+    Fallback batch recognition path: tile all images into one page
+    and call the tesseract binary once, then assign every recognised
+    word back to the image it was found in using the tile offsets.
+    """
+    page, offsets = tile_images(images)
+    data = pytesseract.image_to_data(Image.fromarray(page),
+                                     lang=TESSERACT_LANG,
+                                     config=TESSERACT_CONFIG,
+                                     output_type=pytesseract.Output.DICT)
+
+    # {image index: {(block, paragraph, line): [words]}}, in reading order
+    lines = [{} for _ in images]
+    for i, word in enumerate(data['text']):
+        if not word.strip():
+            continue
+        center_y = data['top'][i] + data['height'][i] / 2
+        index = max(np.searchsorted(offsets, center_y, side='right') - 1, 0)
+        line = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        lines[index].setdefault(line, []).append(word)
+
+    return ['\n'.join(' '.join(words) for words in image_lines.values())
+            for image_lines in lines]
+
+
+def get_ocr_executor() -> Optional[Executor]:
+    """
+    Return the executor shared by all requests of this process, creating
+    it on first use. The executor is re-created after a fork (e.g. in
+    gunicorn workers), since worker threads/processes are not inherited.
+    Returns None when regions should be recognised serially.
+    """
+    global _executor, _executor_pid
+
+    if OCR_EXECUTOR == 'serial' or OCR_WORKERS < 2:
+        return None
+    if OCR_EXECUTOR not in ('thread', 'process'):
+        raise ValueError('Unknown OCR_EXECUTOR: {}'.format(OCR_EXECUTOR))
+
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            executor_class = (ProcessPoolExecutor if OCR_EXECUTOR == 'process'
+                              else ThreadPoolExecutor)
+            _executor = executor_class(max_workers=OCR_WORKERS)
+            _executor_pid = os.getpid()
+    return _executor
+
+
+def ocr_serial(images: List[np.ndarray], scale: float = OCR_SCALE) -> List[Text]:
+    """
+    Perform ocr on several regions in a single engine session on
+    the calling thread. Results are in the same order as images.
+    """
+    if not images:
+        return []
+
+    processed = [preprocess(image, scale=scale) for image in images]
+    if IN_PROCESS and tesseract_pool.available:
+        try:
+            # the same warm engine recognises every region
+            return tesseract_pool.recognise_all(processed)
+        except RuntimeError:
+            # engine could not be initialised, fall back to the binary
+            pass
+    return recognise_tiled(processed)
+
+
+def ocr_batch(images: List[np.ndarray], scale: float = OCR_SCALE) -> List[Text]:
+    """
+    Perform ocr on all regions of a document, so that the tesseract
+    model is loaded once per document rather than once per region.
+
+    Regions are split into contiguous chunks that are recognised in
+    parallel by the shared executor (each chunk in a single engine
+    session), and results are returned in the same order as images.
+    :param images: regions of the document
+    :param scale: scaling factor applied to every region (see preprocess)
+    """
+    executor = get_ocr_executor()
+    if executor is None or len(images) < 2:
+        return ocr_serial(images, scale=scale)
+
+    bounds = np.linspace(0, len(images), min(OCR_WORKERS, len(images)) + 1,
+                         dtype=int)
+    chunks = [images[start:end] for start, end in zip(bounds, bounds[1:])]
+
+    texts = []
+    for chunk_texts in executor.map(functools.partial(ocr_serial, scale=scale), chunks):
+        texts.extend(chunk_texts)
+    return texts
 
 
 def detect_text_pytesseract(image_bytes: bytes) -> List[Text]:
@@ -0,0 +1,70 @@
+"""
+Compare merge_boxes with the all-pairs merge_boxes_pairwise on synthetic
+dense layouts (lines of words, plus boxes nested in them, as CTPN finds
+on a page of text), and check that both merge the same boxes.
+
+Run as a script, so that box.py is imported from this directory
+without the flaskapp package (which loads the engines on import):
+    python flaskapp/analysis/utils/benchmark_merge_boxes.py [repeats]
+"""
+
+from typing import List
+import sys
+import time
+
+import numpy as np
+
+from box import Box, merge_boxes, merge_boxes_pairwise
+
+
+def make_layout(num_boxes: int,
+                width: int = 1200,
+                line_height: int = 24,
+                nested: float = 0.1,
+                seed: int = 0) -> List[Box]:
+    """
+    Return num_boxes boxes laid out in lines of words of random widths
+    and gaps, a share (nested) of which lie within another box
+    """
+    rng = np.random.RandomState(seed)
+    boxes = []
+    y = 0
+    while len(boxes) < num_boxes:
+        x = int(rng.randint(0, 40))
+        while x < width and len(boxes) < num_boxes:
+            w = int(rng.randint(20, 120))
+            h = line_height + int(rng.randint(-3, 4))
+            boxes.append(Box(x, y + int(rng.randint(-2, 3)), w, h))
+            if rng.rand() < nested and w > 10 and len(boxes) < num_boxes:
+                boxes.append(Box(x + 2, y + 2, w - 4, h - 4))
+            x += w + int(rng.randint(5, 80))
+        y += line_height + int(rng.randint(10, 60))
+    order = rng.permutation(len(boxes))
+    return [boxes[i] for i in order]
+
+
+def coordinates(boxes: List[Box]) -> list:
+    return [(box.top_left_x, box.top_left_y, box.width, box.height) for box in boxes]
+
+
+def benchmark(num_boxes: int, repeats: int):
+    boxes = make_layout(num_boxes)
+    # thresholds used by detect_text_ctpn on a 600x1200 image
+    v_thresh, h_thresh = 30, 60
+
+    results = {}
+    for name, function in [('pairwise', merge_boxes_pairwise), ('grid', merge_boxes)]:
+        start = time.time()
+        for _ in range(repeats):
+            merged = function(list(boxes), v_thresh=v_thresh, h_thresh=h_thresh)
+        elapsed = (time.time() - start) / repeats
+        results[name] = coordinates(merged)
+        print('  {:8} {:8.1f} ms  {} boxes left'.format(name, elapsed * 1000, len(merged)))
+    print('  {}'.format('same' if results['grid'] == results['pairwise'] else 'DIFFERENT'))
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for num_boxes in [25, 100, 400]:
+        print('{} boxes'.format(num_boxes))
+        benchmark(num_boxes, repeats)
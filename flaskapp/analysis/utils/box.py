@@ -114,7 +114,20 @@ class Box(object):
         return width > 0 and height > 0
 
     def contains(self, other) -> bool:
-        return self.overlap(other) and self.merge(other).area == max(self.area, other.area)
+        """
+        Function to determine whether one of two overlapping boxes
+        lies within the other (i.e. merging them gives the larger box)
+        """
+        return self.overlap(other) and (
+            (self.top_left_x <= other.top_left_x and
+             self.top_left_y <= other.top_left_y and
+             self.bottom_right_x >= other.bottom_right_x and
+             self.bottom_right_y >= other.bottom_right_y)
+            or
+            (other.top_left_x <= self.top_left_x and
+             other.top_left_y <= self.top_left_y and
+             other.bottom_right_x >= self.bottom_right_x and
+             other.bottom_right_y >= self.bottom_right_y))
 
     def near(self,
              other,
@@ -173,12 +186,121 @@ class Box(object):
                    )
 
 
+class BoxGrid(object):
+    """
+    Uniform grid over boxes, to find the boxes that may lie within
+    a given distance of a box without comparing it with every box
+    """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _cells(self, box: Box, margin: float = 0):
+        x0 = int((box.top_left_x - margin) // self.cell_size)
+        x1 = int((box.bottom_right_x + margin) // self.cell_size)
+        y0 = int((box.top_left_y - margin) // self.cell_size)
+        y1 = int((box.bottom_right_y + margin) // self.cell_size)
+        return ((x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+
+    def insert(self, key: int, box: Box):
+        for cell in self._cells(box):
+            self.cells.setdefault(cell, []).append(key)
+
+    def query(self, box: Box, margin: float) -> set:
+        """
+        Return the keys of the boxes inserted in a cell within margin of
+        box: a superset of the boxes less than margin away from it
+        """
+        keys = set()
+        for cell in self._cells(box, margin):
+            keys.update(self.cells.get(cell, ()))
+        return keys
+
+
+def _merge_rounds(boxes: List[Box], should_merge, margin: float) -> List[Box]:
+    """
+    Merge boxes in rounds, as merge_boxes_pairwise does: in each round,
+    every pair (i, j) of the boxes at the start of the round, in order,
+    for which should_merge holds is merged if neither box was merged yet
+    in that round. Merged boxes are appended, and compared in the next
+    round. should_merge must only hold for boxes less than margin apart.
+
+    Boxes are numbered in the order of the list of merge_boxes_pairwise
+    (surviving boxes keep their order, merged boxes are appended), and
+    pairs are found with a grid instead of all combinations. After the
+    first round, only pairs with a box merged in the previous round
+    can merge: two boxes that survived a round were compared in it.
+    """
+    boxes = list(boxes)
+    if len(boxes) < 2:
+        return boxes
+
+    sizes = [max(box.width, box.height) for box in boxes]
+    grid = BoxGrid(cell_size=max(sum(sizes) / len(sizes), margin, 1))
+    for key, box in enumerate(boxes):
+        grid.insert(key, box)
+
+    alive = [True] * len(boxes)
+    new_start = 0
+    while True:
+        round_end = len(boxes)
+        pairs = []
+        for j in range(new_start, round_end):
+            if not alive[j]:
+                continue
+            for i in grid.query(boxes[j], margin):
+                # each pair once, with at least one box new in this round
+                if i < j and alive[i] and should_merge(boxes[i], boxes[j]):
+                    pairs.append((i, j))
+        if not pairs:
+            break
+
+        pairs.sort()
+        for i, j in pairs:
+            if alive[i] and alive[j]:
+                alive[i] = alive[j] = False
+                boxes.append(boxes[i].merge(boxes[j]))
+                alive.append(True)
+        for key in range(round_end, len(boxes)):
+            grid.insert(key, boxes[key])
+        new_start = round_end
+
+    return [box for box, is_alive in zip(boxes, alive) if is_alive]
+
+
 def merge_boxes(boxes: List[Box],
                 v_thresh: int,
                 h_thresh: int) -> Sequence[Box]:
     """
     Iterate through a sequence of boxes and merge boxes
     that lie within one another, or are close enough to one another.
+
+    Same result as merge_boxes_pairwise, comparing each box only with
+    the boxes around it (a union-find over all merging pairs would be
+    faster still, but gives different results: e.g. if A and C both
+    contain B, merge_boxes_pairwise merges A and B, and keeps C apart)
+    """
+    if any(box.width < 0 or box.height < 0 for box in boxes):
+        # the grid assumes boxes are not inverted
+        return merge_boxes_pairwise(boxes, v_thresh=v_thresh, h_thresh=h_thresh)
+
+    # boxes within one another overlap
+    boxes = _merge_rounds(boxes, Box.contains, margin=0)
+
+    # near boxes are less than the largest threshold apart
+    return _merge_rounds(boxes,
+                         lambda box1, box2: box1.near(box2, v_thresh=v_thresh, h_thresh=h_thresh),
+                         margin=max(v_thresh, h_thresh, 0))
+
+
+def merge_boxes_pairwise(boxes: List[Box],
+                         v_thresh: int,
+                         h_thresh: int) -> Sequence[Box]:
+    """
+    Iterate through a sequence of boxes and merge boxes
+    that lie within one another, or are close enough to one another.
+    Compares all pairs of boxes in every round (reference for merge_boxes)
     """
     contains = [(box1, box2) for (box1, box2) in combinations(boxes, 2) if box1.contains(box2)]
 
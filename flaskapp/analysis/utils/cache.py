@@ -0,0 +1,276 @@
+"""Content-addressed cache for OCR results."""
+
+from typing import Any, Callable, Dict, Optional, Text
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Part of every cache key: bump it when a change to the detection or OCR
+# code changes results, so that results cached by older code are not
+# served. OCR_CACHE_VERSION can also be set to invalidate the cache
+CACHE_VERSION = '1:' + os.environ.get('OCR_CACHE_VERSION', '')
+
+
+def dump_json_atomic(path: Text, value: Any):
+    """
+    Write value as JSON to path, through a temp file in the same
+    directory so that concurrent readers never see a partial file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as file:
+        json.dump(value, file)
+    os.replace(tmp_path, path)
+
+
+class OCRCache(object):
+    """
+    Cache of OCR results keyed by a hash of the image bytes together
+    with the engine name and its configuration, so that resubmitting
+    the same photo does not recompute (or pay for) the same result.
+
+    Results are kept in an in-memory LRU, and optionally in a directory
+    of JSON files shared by all processes, which expire after ttl seconds.
+    The directory is pruned of expired files, and of the oldest ones
+    beyond max_files, by the process writing to it at most every
+    prune_interval seconds. Cached values must be JSON serialisable.
+    """
+
+    def __init__(self,
+                 max_entries: int = 256,
+                 cache_dir: Text = None,
+                 ttl: float = None,
+                 max_files: int = 10000,
+                 prune_interval: float = 300):
+        """
+        :param max_entries: maximum number of results kept in memory,
+                            0 disables the in-memory tier
+        :param cache_dir: directory of the on-disk tier, None disables it
+        :param ttl: seconds after which on-disk results expire,
+                    None to never expire
+        :param max_files: maximum number of on-disk results,
+                          None for no limit
+        :param prune_interval: minimum seconds between two prunes
+                               of the on-disk tier by this process
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_files = max_files
+        self.prune_interval = prune_interval
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # key -> [lock held while computing the key, number of users]
+        self._inflight = {}
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._last_prune = 0.0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Configure the cache from environment variables
+        """
+        ttl = os.environ.get('OCR_CACHE_TTL')
+        max_files = int(os.environ.get('OCR_CACHE_MAX_FILES', 10000))
+        return cls(max_entries=int(os.environ.get('OCR_CACHE_SIZE', 256)),
+                   cache_dir=os.environ.get('OCR_CACHE_DIR') or None,
+                   ttl=float(ttl) if ttl else None,
+                   max_files=max_files if max_files > 0 else None)
+
+    @staticmethod
+    def make_key(image_bytes: bytes, engine: Text, config: Text) -> Text:
+        """
+        Return the cache key of an image processed by an engine,
+        with the current CACHE_VERSION of the code
+        :param image_bytes: image as uploaded
+        :param engine: name of the engine, e.g. 'gcp'
+        :param config: anything that affects the engine output
+        """
+        digest = hashlib.sha256()
+        for part in (CACHE_VERSION.encode(), engine.encode(), config.encode(), image_bytes):
+            # hash the length first so that parts cannot run into each other
+            digest.update(str(len(part)).encode() + b':')
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key: Text) -> Text:
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def _get_memory(self, key: Text) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def _set_memory(self, key: Text, value: Any):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_disk(self, key: Text) -> Optional[Any]:
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            # missing, concurrently removed or partially written entry
+            return None
+
+    def _set_disk(self, key: Text, value: Any):
+        if not self.cache_dir:
+            return
+        dump_json_atomic(self._path(key), value)
+
+        # the directory only grows on writes, prune it every now and then
+        now = time.time()
+        with self._lock:
+            due = now - self._last_prune >= self.prune_interval
+            if due:
+                self._last_prune = now
+        if due:
+            self.prune()
+
+    def prune(self) -> int:
+        """
+        Remove expired on-disk results, then the oldest ones beyond
+        max_files. Returns the number of files removed
+        """
+        if not self.cache_dir:
+            return 0
+
+        now = time.time()
+        entries = []
+        try:
+            subdirs = os.listdir(self.cache_dir)
+        except OSError:
+            return 0
+        for subdir in subdirs:
+            subdir = os.path.join(self.cache_dir, subdir)
+            try:
+                filenames = os.listdir(subdir)
+            except OSError:
+                continue
+            for filename in filenames:
+                # skip temp files of results being written
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(subdir, filename)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    # removed by another process
+                    pass
+
+        entries.sort()
+        expired = 0
+        if self.ttl is not None:
+            while expired < len(entries) and now - entries[expired][0] > self.ttl:
+                expired += 1
+        excess = len(entries) - expired - self.max_files if self.max_files else 0
+
+        removed = 0
+        for _, path in entries[:expired + max(excess, 0)]:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def get(self, key: Text) -> Optional[Any]:
+        """
+        Return the cached value for key, or None if there is none
+        """
+        value = self._get_memory(key)
+        if value is not None:
+            self._count('memory_hits')
+            return value
+
+        value = self._get_disk(key)
+        if value is not None:
+            self._count('disk_hits')
+            self._set_memory(key, value)
+            return value
+
+        self._count('misses')
+        return None
+
+    def set(self, key: Text, value: Any):
+        """
+        Store value for key in all tiers
+        """
+        self._set_memory(key, value)
+        self._set_disk(key, value)
+
+    def get_or_compute(self,
+                       image_bytes: bytes,
+                       engine: Text,
+                       config: Text,
+                       compute: Callable[[], Any]) -> Any:
+        """
+        Return the cached result of engine for image_bytes,
+        calling compute() and caching its result on a miss. Threads
+        missing the same key at the same time compute it only once
+        """
+        key = self.make_key(image_bytes, engine, config)
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        # concurrent misses on the same key wait for a single computation
+        with self._lock:
+            inflight = self._inflight.setdefault(key, [threading.Lock(), 0])
+            inflight[1] += 1
+        try:
+            with inflight[0]:
+                # computed by another thread while waiting?
+                value = self._get_memory(key)
+                if value is None:
+                    value = self._get_disk(key)
+                if value is None:
+                    value = compute()
+                    self.set(key, value)
+        finally:
+            with self._lock:
+                inflight[1] -= 1
+                if not inflight[1]:
+                    del self._inflight[key]
+        return value
+
+    def _count(self, stat: Text):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def stats(self) -> Dict[Text, Any]:
+        """
+        Return hit/miss counters since the process started
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        hits = stats['memory_hits'] + stats['disk_hits']
+        stats['hits'] = hits
+        stats['hit_rate'] = hits / (hits + stats['misses']) if hits + stats['misses'] else 0.0
+        return stats
+
+    def clear(self):
+        """
+        Drop all in-memory entries (on-disk entries are left to expire)
+        """
+        with self._lock:
+            self._entries.clear()
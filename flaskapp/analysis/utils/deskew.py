@@ -1,75 +1,188 @@
+from typing import Text, Tuple
+import os
+
 import numpy as np
 import cv2
 
+# skew angles smaller than this (in degrees) are not worth rotating for
+MIN_ROTATION_DEGREES = 1.0
 
-def skew_angle(image: np.ndarray, DEBUG: bool = False) -> float:
-    """
-    Function to detect the edges (lines) in an image
-    and calculate the skew angle. Ideally, the lines
-    should be drawn parallel to text direction
-    or obvious image borders.
-
-    If DEBUG=TRUE, show image with lines drawn
-    """
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    edges = cv2.Canny(gray, 200, 200)
+# estimate_skew only looks for skew angles within +/- this (in degrees)
+MAX_SKEW_DEGREES = 15.0
 
-    lines = cv2.HoughLinesP(edges, rho=1, theta=np.pi / 180,
-                            threshold=80, minLineLength=120,
-                            maxLineGap=10)
-    deg_angles = []
+# estimates less confident than this are ignored
+MIN_SKEW_CONFIDENCE = 0.3
 
-    if lines is not None:
-        for line in lines:
-            x1, y1, x2, y2 = line[0]
+# images are downsampled so that their longer side is at most this
+# before looking for lines
+DESKEW_MAX_SIZE = 600
 
-            # hough lines returns a list of lines with points
-            # in the form (x1, y1, x2, y2).
-            # The first step is to calculate the slopes of
-            # these lines from their paired point values
-            slope = (y2 - y1) / (x2 - x1)
+# method used by estimate_skew: 'hough' (lines of the edge map)
+# or 'projection' (sharpest horizontal projection profile)
+DESKEW_METHOD = os.environ.get('DESKEW_METHOD', 'hough')
 
-            # it just so happens that this slope is also
-            # y where y = tan(theta), the angle
-            # in a circle by which the line is offset
-            rad_angle = np.arctan(slope)
-            deg_angles.append(np.degrees(rad_angle))
+# How skewed uploads are straightened by detect_text_ctpn: 'rotate' the
+# whole image before detection, or detect on the skewed image and only map
+# the detected 'boxes' into the straightened image, warping only the crops
+DESKEW_MODE = os.environ.get('CTPN_DESKEW_MODE', 'rotate')
 
-        if DEBUG:
-            copy = image.copy()
-            for line in lines:
-                x1, y1, x2, y2 = line[0]
 
-                slope = (y2 - y1) / (x2 - x1) if (x2 - x1) else 0
-                rad_angle = np.arctan(slope)
-                deg_angle = np.degrees(rad_angle)
+def line_angles(lines: np.ndarray) -> np.ndarray:
+    """
+    Return the angles (in degrees, within [-90, 90)) of lines
+    given as (x1, y1, x2, y2), vertical lines included
+    :param lines: array of lines, as returned by HoughLinesP
+    """
+    lines = lines.reshape(-1, 4).astype(np.float64)
+    deg_angles = np.degrees(np.arctan2(lines[:, 3] - lines[:, 1],
+                                       lines[:, 2] - lines[:, 0]))
+    # a line has the same angle whichever way it is drawn
+    return (deg_angles + 90) % 180 - 90
 
-                cv2.line(copy, (x1, y1), (x2, y2), (0, 0, 255), 2)
-                cv2.putText(copy, str(np.round(deg_angle)), (x1, y1),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 1)
-            cv2.imshow('image', copy)
-            cv2.waitKey(0)
-            cv2.destroyAllWindows()
 
-        # which of these degree values is most common?
-        hist = np.histogram(deg_angles, bins=180)
-        angle = hist[1][np.argmax(hist[0])]
+def downsample(image: np.ndarray, max_size: int = DESKEW_MAX_SIZE) -> (np.ndarray, float):
+    """
+    Convert an image to grayscale and shrink it so that its longer side
+    is at most max_size. Returns the image and the scale applied
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    f = min(1.0, float(max_size) / max(gray.shape[0], gray.shape[1]))
+    if f < 1.0:
+        gray = cv2.resize(gray, None, None, fx=f, fy=f,
+                          interpolation=cv2.INTER_AREA)
+    return gray, f
 
-        return angle
 
-    return 0.0
+def hough_skew(gray: np.ndarray,
+               f: float = 1.0,
+               max_angle: float = MAX_SKEW_DEGREES) -> Tuple[float, float]:
+    """
+    Estimate the skew angle of a grayscale image from the lines of its
+    edge map (Canny edges, then probabilistic Hough lines, with lengths
+    scaled by f, the scale the image was downsampled by). Ideally, the
+    lines are parallel to text direction or obvious image borders.
+    Returns (angle, confidence) where confidence is the share of line
+    length agreeing with the angle
+    """
+    edges = cv2.Canny(gray, 200, 200)
+    lines = cv2.HoughLinesP(edges, rho=1, theta=np.pi / 180,
+                            threshold=max(int(80 * f), 10),
+                            minLineLength=max(int(120 * f), 20),
+                            maxLineGap=max(int(round(10 * f)), 1))
+    if lines is None:
+        return 0.0, 0.0
+
+    lines = lines.reshape(-1, 4).astype(np.float64)
+    deg_angles = line_angles(lines)
+    lengths = np.hypot(lines[:, 2] - lines[:, 0], lines[:, 3] - lines[:, 1])
+    total = lengths.sum()
+
+    in_range = np.abs(deg_angles) <= max_angle
+    if not in_range.any() or total == 0:
+        return 0.0, 0.0
+    deg_angles = deg_angles[in_range]
+    lengths = lengths[in_range]
+
+    # most common angle, by line length, in 1 degree bins; the estimate
+    # is the mean angle of the lines in that bin and its neighbours
+    bins = np.round(deg_angles).astype(int)
+    weights = np.bincount(bins + int(np.ceil(max_angle)), weights=lengths)
+    peak = np.argmax(weights) - int(np.ceil(max_angle))
+    agree = np.abs(bins - peak) <= 1
+    angle = np.average(deg_angles[agree], weights=lengths[agree])
+    return float(angle), float(lengths[agree].sum() / total)
+
+
+def projection_skew(gray: np.ndarray,
+                    max_angle: float = MAX_SKEW_DEGREES,
+                    step: float = 1.0,
+                    fine_step: float = 0.1) -> Tuple[float, float]:
+    """
+    Estimate the skew angle of a grayscale image as the angle whose
+    horizontal projection profile of dark pixels is the sharpest (text
+    lines then fall into few rows). Only the coordinates of dark pixels
+    are rotated, not the image. Angles are searched every step degrees,
+    then refined every fine_step degrees around the best one; if the
+    image is clearly sharpest unrotated, the search stops there. Returns
+    (angle, confidence) where confidence is how much sharper the profile
+    is at angle than on average over the angles searched
+    """
+    _, binary = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    ys, xs = np.nonzero(binary)
+    if len(xs) == 0:
+        return 0.0, 0.0
+    xs = xs - gray.shape[1] / 2.0
+    ys = ys - gray.shape[0] / 2.0
+    offset = np.hypot(gray.shape[0], gray.shape[1]) / 2.0
+
+    def sharpness(degrees: float) -> float:
+        # rows of the pixels once the image is rotated by degrees
+        r = np.deg2rad(degrees)
+        rows = (ys * np.cos(r) - xs * np.sin(r) + offset).astype(np.int64)
+        profile = np.bincount(rows).astype(np.float64)
+        return float(np.sum(np.diff(profile) ** 2))
+
+    scores = {0.0: sharpness(0.0)}
+    for degrees in (-step, step):
+        scores[degrees] = sharpness(degrees)
+    if max(scores[-step], scores[step]) <= 0.5 * scores[0.0]:
+        # already straight (most uploads are): text lines blur as soon
+        # as the image is rotated by step
+        angle = 0.0
+    else:
+        for degrees in np.arange(-max_angle, max_angle + step / 2, step):
+            degrees = float(np.round(degrees, 6))
+            if degrees not in scores:
+                scores[degrees] = sharpness(degrees)
+        coarse = max(scores, key=scores.get)
+        for degrees in np.arange(coarse - step, coarse + step + fine_step / 2, fine_step):
+            degrees = float(np.round(degrees, 6))
+            if abs(degrees) <= max_angle and degrees not in scores:
+                scores[degrees] = sharpness(degrees)
+        angle = max(scores, key=scores.get)
+
+    best = scores[angle]
+    if best == 0:
+        return 0.0, 0.0
+    return angle, 1.0 - float(np.mean(list(scores.values()))) / best
+
+
+def estimate_skew(image: np.ndarray,
+                  max_angle: float = MAX_SKEW_DEGREES,
+                  method: Text = None,
+                  max_size: int = DESKEW_MAX_SIZE) -> Tuple[float, float]:
+    """
+    Estimate the skew angle of an image downsampled so that its longer
+    side is at most max_size, only looking for angles within +/- max_angle
+    degrees.
+
+    Returns (angle, confidence), where angle is the angle to rotate the
+    image by (see rotate) to straighten it, and confidence
+    in [0, 1] (0 when nothing to estimate from)
+    :param image: image to be straightened
+    :param max_angle: largest skew angle expected, in degrees
+    :param method: 'hough' or 'projection', DESKEW_METHOD by default
+    :param max_size: size the image is downsampled to
+    """
+    method = method or DESKEW_METHOD
+    gray, f = downsample(image, max_size)
+    if method == 'projection':
+        return projection_skew(gray, max_angle)
+    if method == 'hough':
+        return hough_skew(gray, f, max_angle)
+    raise ValueError('Unknown deskew method {}, choose from: hough, projection'.format(method))
 
 
-def rotate(image: np.ndarray, degrees: float) -> np.ndarray:
+def rotation_matrix(shape: tuple, degrees: float) -> (np.ndarray, Tuple[int, int]):
     """
-    Function to rotate an image counter-clockwise
-    by X degrees, where X is in the range [-360, 360]
+    Return the affine matrix rotating an image of the given shape
+    counter-clockwise by degrees about its center, translated so that
+    no corner is cut off, and the (width, height) of the rotated image
     """
-
-    (oldX, oldY) = image.shape[1], image.shape[0]
+    (oldX, oldY) = shape[1], shape[0]
     mat = cv2.getRotationMatrix2D(center=(oldX / 2, oldY / 2),
-                                angle=degrees,
-                                scale=1.0)  # rotate about center of image.
+                                  angle=degrees,
+                                  scale=1.0)  # rotate about center of image.
 
     # include this if you want to prevent corners being cut off
     r = np.deg2rad(degrees)
@@ -90,5 +203,28 @@ def rotate(image: np.ndarray, degrees: float) -> np.ndarray:
     mat[0, 2] += tx
     mat[1, 2] += ty
 
-    rotated = cv2.warpAffine(image, mat, dsize=(int(newX), int(newY)))
+    return mat, (int(newX), int(newY))
+
+
+def rotate_points(points: np.ndarray, mat: np.ndarray) -> np.ndarray:
+    """
+    Map (N, 2) points (x, y) through an affine matrix,
+    e.g. from rotation_matrix
+    """
+    return np.asarray(points, np.float64) @ mat[:, :2].T + mat[:, 2]
+
+
+def rotate(image: np.ndarray,
+           degrees: float,
+           min_degrees: float = 0.0) -> np.ndarray:
+    """
+    Function to rotate an image counter-clockwise
+    by X degrees, where X is in the range [-360, 360].
+    The image is returned as is if |X| is under min_degrees
+    """
+    if abs(degrees) < min_degrees or degrees == 0:
+        return image
+
+    mat, dsize = rotation_matrix(image.shape, degrees)
+    rotated = cv2.warpAffine(image, mat, dsize=dsize)
     return rotated
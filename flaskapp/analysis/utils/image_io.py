@@ -0,0 +1,80 @@
+"""Image decoding helpers."""
+
+from typing import Optional, Tuple
+import struct
+
+import cv2
+import numpy as np
+
+# JPEG decoding can downscale by these factors in the DCT domain,
+# without materialising the full resolution bitmap
+REDUCED_DECODE_FLAGS = {8: cv2.IMREAD_REDUCED_COLOR_8,
+                        4: cv2.IMREAD_REDUCED_COLOR_4,
+                        2: cv2.IMREAD_REDUCED_COLOR_2}
+
+# start of frame markers, which hold the image dimensions
+# (0xC4, 0xC8 and 0xCC are other segments in the same range)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(image_bytes: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Read the (height, width) of a JPEG image from its header, without
+    decoding it. Returns None if image_bytes is not a (valid) JPEG
+    :param image_bytes: encoded image
+    """
+    if image_bytes[:2] != b'\xff\xd8':
+        return None
+
+    i = 2
+    while i + 9 <= len(image_bytes):
+        if image_bytes[i] != 0xFF:
+            return None
+        marker = image_bytes[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # markers without a segment
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack('>HH', image_bytes[i + 5:i + 9])
+            return height, width
+        segment_length, = struct.unpack('>H', image_bytes[i + 2:i + 4])
+        i += 2 + segment_length
+
+    return None
+
+
+def decode_image(image_bytes: bytes,
+                 scale: int = None,
+                 max_scale: int = None) -> np.ndarray:
+    """
+    Decode an image that is going to be resized so that its shorter side
+    is scale, and its longer side at most max_scale. Large JPEGs are decoded at 1/2, 1/4 or 1/8 resolution,
+    the largest reduction that keeps the image at least as large as the
+    resized image, so the full resolution bitmap is never created.
+    Other images (or without scale) are decoded at full resolution
+    :param image_bytes: encoded image
+    :param scale: target size of the shorter side
+    :param max_scale: maximum size of the longer side
+    """
+    img_array = np.frombuffer(image_bytes, np.uint8)
+
+    size = jpeg_size(image_bytes) if scale else None
+    if size is not None and min(size) > 0:
+        # same scaling factor as the CTPN blob (_get_image_scale)
+        f = float(scale) / min(size)
+        if max_scale and f * max(size) > max_scale:
+            f = float(max_scale) / max(size)
+
+        for reduction, flags in sorted(REDUCED_DECODE_FLAGS.items(), reverse=True):
+            if f * reduction <= 1:
+                img = cv2.imdecode(img_array, flags)
+                if img is not None:
+                    return img
+                break
+
+    return cv2.imdecode(img_array, cv2.IMREAD_ANYCOLOR)
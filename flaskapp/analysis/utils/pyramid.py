@@ -0,0 +1,67 @@
+"""Multi-resolution view of an uploaded image, shared by the pipeline stages."""
+
+import cv2
+import numpy as np
+
+from flaskapp.analysis.utils.image_io import decode_image
+
+
+class ImagePyramid(object):
+    """
+    An image decoded once, and levels resampled from it on first use.
+    A level is identified by its scale relative to the decoded image, so
+    each stage picks the resolution it needs (e.g. ~600 px for CTPN,
+    the sharpest level for OCR crops) and converts coordinates between
+    levels with transform, instead of resampling an already resampled
+    image.
+    """
+
+    def __init__(self, image: np.ndarray):
+        """
+        :param image: decoded image, the sharpest level (scale 1)
+        """
+        self.image = image
+        self._levels = {}
+
+    @classmethod
+    def decode(cls,
+               image_bytes: bytes,
+               scale: int = None,
+               max_scale: int = None):
+        """
+        Decode an image, at reduced resolution if it is larger than needed
+        for a level of scale/max_scale (see decode_image)
+        :param image_bytes: encoded image
+        :param scale: size of the shorter side of the largest level needed
+        :param max_scale: maximum size of the longer side of that level
+        """
+        return cls(decode_image(image_bytes, scale=scale, max_scale=max_scale))
+
+    @property
+    def shape(self):
+        # shape of the decoded image
+        return self.image.shape
+
+    def level(self, scale: float) -> np.ndarray:
+        """
+        Return the image resampled by scale, relative to the decoded image.
+        Levels are built from the decoded image on first use and kept
+        """
+        image = self._levels.get(scale)
+        if image is None:
+            image = self.image
+            if scale != 1.0:
+                image = cv2.resize(image, None, None, fx=scale, fy=scale,
+                                   interpolation=cv2.INTER_LINEAR)
+            self._levels[scale] = image
+        return image
+
+    @staticmethod
+    def transform(coords: np.ndarray,
+                  from_scale: float,
+                  to_scale: float) -> np.ndarray:
+        """
+        Convert pixel coordinates (or sizes) in the level of scale
+        from_scale into coordinates in the level of scale to_scale
+        """
+        return np.asarray(coords) * (to_scale / from_scale)
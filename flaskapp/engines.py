@@ -0,0 +1,146 @@
+"""Registry of OCR engines that are loaded lazily, on first use or on warmup."""
+
+from typing import Callable, List, Text
+import functools
+import os
+import threading
+
+from flaskapp import ctpn_dir
+
+# an engine takes image bytes and returns the chunks of text in the image
+Engine = Callable[[bytes], List[Text]]
+
+
+class EngineRegistry(object):
+    """
+    Map engine names to loaders, and load each engine the first time it
+    is needed, so that a process only pays (in startup time and memory)
+    for the engines it actually serves.
+
+    Loaded engines belong to the process that loaded them: after a fork,
+    engines are loaded again, since e.g. tensorflow sessions and gRPC
+    channels cannot be used from a forked child.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._engines = {}
+        self._locks = {}
+        self._pid = os.getpid()
+
+    def register(self, name: Text, loader: Callable[[], Engine]):
+        """
+        Register a loader, called without arguments the first time
+        the engine is needed, and returning the engine
+        """
+        self._loaders[name] = loader
+        self._locks[name] = threading.Lock()
+
+    @property
+    def names(self) -> List[Text]:
+        return list(self._loaders)
+
+    @property
+    def loaded(self) -> List[Text]:
+        return list(self._engines) if self._pid == os.getpid() else []
+
+    def get(self, name: Text) -> Engine:
+        """
+        Return the engine called name, loading it if necessary.
+        Raises KeyError for unknown engines
+        """
+        if self._pid != os.getpid():
+            self._engines = {}
+            self._locks = {engine: threading.Lock() for engine in self._loaders}
+            self._pid = os.getpid()
+
+        engine = self._engines.get(name)
+        if engine is None:
+            # one lock per engine, so that loading a slow engine
+            # does not block requests for the other engines
+            with self._locks[name]:
+                engine = self._engines.get(name)
+                if engine is None:
+                    engine = self._loaders[name]()
+                    self._engines[name] = engine
+        return engine
+
+    def warmup(self, names: List[Text] = None):
+        """
+        Load the given engines (all registered engines by default)
+        now rather than on first use
+        """
+        for name in self.names if names is None else names:
+            self.get(name)
+
+
+def load_gcp() -> Engine:
+    from flaskapp.analysis.gcp.vision_gcp import detect_text_gcp
+    return detect_text_gcp
+
+
+def ctpn_model_filepath() -> Text:
+    """
+    Return the CTPN graph to load: ctpn.pb, or its conversion with
+    memory-mapped weights if CTPN_MMAP_DIR is set, so that all processes
+    share a single copy of the weights
+    """
+    model_filepath = os.path.join(ctpn_dir, 'ctpn.pb')
+    mmap_dir = os.environ.get('CTPN_MMAP_DIR')
+    if not mmap_dir:
+        return model_filepath
+
+    from flaskapp.analysis.ctpn.shared_weights import ensure_converted
+    return ensure_converted(model_filepath, mmap_dir)
+
+
+def load_ctpn() -> Engine:
+    # tensorflow is only imported once a CTPN engine is needed
+    from flaskapp.analysis.ctpn.model import CTPNModel
+    from flaskapp.analysis.ctpn.batcher import CTPNBatcher
+    from flaskapp.analysis.ctpn.vision_ctpn import detect_text_ctpn
+
+    model = CTPNModel.from_env(
+        config_filepath=os.path.join(ctpn_dir, 'text.yml'),
+        model_filepath=ctpn_model_filepath())
+
+    # Share forward passes between concurrent requests (None if disabled)
+    batcher = CTPNBatcher.from_env(model)
+
+    return functools.partial(detect_text_ctpn, model=model, batcher=batcher)
+
+
+def load_pytesseract() -> Engine:
+    from flaskapp.analysis.pytesseract.vision_pytesseract import detect_text_pytesseract
+    return detect_text_pytesseract
+
+
+engines = EngineRegistry()
+engines.register('gcp', load_gcp)
+engines.register('ctpn', load_ctpn)
+engines.register('pytesseract', load_pytesseract)
+
+
+def preload_engines(names: Text = None):
+    """
+    Load the engines listed in a comma separated string,
+    by default from the PRELOAD_ENGINES environment variable
+    """
+    if names is None:
+        names = os.environ.get('PRELOAD_ENGINES', 'ctpn')
+    engines.warmup([name.strip() for name in names.split(',') if name.strip()])
+
+
+def preload_shared_weights():
+    """
+    Load the memory-mapped CTPN weights (if CTPN_MMAP_DIR is set) without
+    loading any engine. Used by the gunicorn master when the app is
+    preloaded: forked workers then find the weights already in memory
+    and share those pages, while sessions are only created after fork
+    """
+    if not os.environ.get('CTPN_MMAP_DIR'):
+        return
+
+    from flaskapp.analysis.ctpn.shared_weights import map_weights
+    model_filepath = ctpn_model_filepath()
+    map_weights(os.path.dirname(model_filepath))
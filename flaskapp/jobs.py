@@ -0,0 +1,187 @@
+"""In-process job queue to run the OCR pipeline asynchronously."""
+
+from typing import Any, Callable, Dict, Optional, Text
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+import uuid
+
+from flaskapp.analysis.utils.cache import dump_json_atomic
+
+
+class QueueFull(Exception):
+    """Raised when too many jobs are already waiting to run."""
+
+
+class MemoryJobStore(object):
+    """
+    Keep job states in memory. Jobs can only be polled from
+    the process that accepted them.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def save(self, job: Dict):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+
+    def load(self, job_id: Text) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def evict(self, ttl: float):
+        now = time.time()
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job['status'] in ('done', 'failed') and now - job['updated'] > ttl:
+                    del self._jobs[job_id]
+
+
+class FileJobStore(object):
+    """
+    Keep job states as JSON files in a local directory, so that a job
+    can be polled from any process (e.g. any gunicorn worker) on the host.
+    """
+
+    def __init__(self, jobs_dir: Text):
+        self.jobs_dir = jobs_dir
+
+    def _path(self, job_id: Text) -> Text:
+        return os.path.join(self.jobs_dir, job_id + '.json')
+
+    def save(self, job: Dict):
+        dump_json_atomic(self._path(job['id']), job)
+
+    def load(self, job_id: Text) -> Optional[Dict]:
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(job_id), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def evict(self, ttl: float):
+        now = time.time()
+        try:
+            filenames = os.listdir(self.jobs_dir)
+        except OSError:
+            return
+        for filename in filenames:
+            # skip temp files of jobs being saved
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.jobs_dir, filename)
+            try:
+                # jobs are saved whenever their status changes
+                if now - os.path.getmtime(path) <= ttl:
+                    continue
+                with open(path, 'r') as file:
+                    job = json.load(file)
+                # like MemoryJobStore, only finished jobs expire
+                if job.get('status') in ('done', 'failed'):
+                    os.remove(path)
+            except (OSError, ValueError):
+                pass
+
+
+class JobQueue(object):
+    """
+    Run functions on a pool of worker threads and keep track of their
+    state, so that a request can return immediately and the client can
+    poll for the result. No external broker is needed: jobs run in the
+    process that accepted them and are lost if that process restarts.
+
+    A job is a dict with id, status ('queued', 'running', 'done' or
+    'failed'), result, error and created/updated timestamps.
+    """
+
+    def __init__(self,
+                 workers: int = 2,
+                 max_pending: int = 100,
+                 ttl: float = 3600,
+                 jobs_dir: Text = None):
+        """
+        :param workers: number of jobs running at the same time
+        :param max_pending: maximum number of queued or running jobs
+        :param ttl: seconds after which finished jobs are forgotten
+        :param jobs_dir: directory to store job states in, so that any
+                         process can answer polls. None keeps them in memory
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.store = FileJobStore(jobs_dir) if jobs_dir else MemoryJobStore()
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = None
+        self._executor_pid = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        Configure the queue from environment variables
+        """
+        return cls(workers=int(os.environ.get('JOB_WORKERS', 2)),
+                   max_pending=int(os.environ.get('JOB_MAX_PENDING', 100)),
+                   ttl=float(os.environ.get('JOB_TTL', 3600)),
+                   jobs_dir=os.environ.get('JOBS_DIR') or None)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # worker threads are not inherited by forked processes
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._executor_pid = os.getpid()
+            self._pending = 0
+        return self._executor
+
+    def _update(self, job: Dict, **fields):
+        job.update(fields, updated=time.time())
+        self.store.save(job)
+
+    def _run(self, job: Dict, fn: Callable, args: tuple):
+        self._update(job, status='running')
+        try:
+            self._update(job, status='done', result=fn(*args))
+        except Exception as e:
+            self._update(job, status='failed',
+                         error='{}: {}'.format(type(e).__name__, e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def submit(self, fn: Callable, *args: Any, **info: Any) -> Dict:
+        """
+        Queue fn(*args) and return the new job. Extra keyword arguments
+        are stored in the job (e.g. engine=...).
+        Raises QueueFull if max_pending jobs are already queued or running.
+        """
+        self.store.evict(self.ttl)
+
+        now = time.time()
+        job = dict(info, id=uuid.uuid4().hex, status='queued',
+                   result=None, error=None, created=now, updated=now)
+
+        with self._lock:
+            executor = self._get_executor()
+            if self._pending >= self.max_pending:
+                raise QueueFull('{} jobs pending'.format(self._pending))
+            self._pending += 1
+
+        self.store.save(job)
+        submitted = dict(job)
+        executor.submit(self._run, job, fn, args)
+        return submitted
+
+    def get(self, job_id: Text) -> Optional[Dict]:
+        """
+        Return the current state of a job, or None if it is unknown
+        (never submitted, or finished more than ttl seconds ago)
+        """
+        return self.store.load(job_id)
@@ -0,0 +1,131 @@
+"""OCR and form validation pipeline shared by the routes and the job queue."""
+
+from typing import Dict, List, Optional, Text
+import os
+
+from flaskapp import ctpn_dir
+from flaskapp.engines import engines
+from flaskapp.analysis.gcp.vision_gcp import detect_text_gcp_batch, GCP_CONFIG
+from flaskapp.analysis.pytesseract.vision_pytesseract import (TESSERACT_CONFIG, TESSERACT_BACKEND,
+                                                               OCR_SCALE)
+from flaskapp.analysis.utils.cache import OCRCache
+from flaskapp.analysis.utils.deskew import (DESKEW_MODE, DESKEW_METHOD, DESKEW_MAX_SIZE,
+                                            MAX_SKEW_DEGREES, MIN_ROTATION_DEGREES,
+                                            MIN_SKEW_CONFIDENCE)
+from flaskapp.analysis.utils.text_utils import (process_text,
+                                                extract_mrz_from_chunks,
+                                                extract_mrz_from_pairs)
+from flaskapp.analysis.utils.validate_form import validate_form
+
+ENGINES = tuple(engines.names)
+
+ocr_cache = OCRCache.from_env()
+
+# the tesseract config and the recognition path (TESSERACT_IN_PROCESS and
+# whether tesserocr is installed)
+RECOGNITION_CONFIG = TESSERACT_CONFIG + ' backend={}'.format(TESSERACT_BACKEND)
+
+# CTPN results depend on the detection config, the tesseract config and
+# every setting that changes the detection input or the proposals
+with open(os.path.join(ctpn_dir, 'text.yml')) as file:
+    CTPN_CONFIG = file.read() + RECOGNITION_CONFIG
+CTPN_CONFIG += ' fused_proposals={} batch_pad={} ocr_scale={}'.format(
+    os.environ.get('CTPN_FUSED_PROPOSALS', '0'),
+    os.environ.get('CTPN_BATCH_PAD', '0'),
+    OCR_SCALE)
+# which uploads are deskewed, by how much and how
+CTPN_CONFIG += ' deskew_mode={} deskew_method={} max_size={} max_degrees={} min_degrees={} min_confidence={}'.format(
+    DESKEW_MODE, DESKEW_METHOD, DESKEW_MAX_SIZE, MAX_SKEW_DEGREES,
+    MIN_ROTATION_DEGREES, MIN_SKEW_CONFIDENCE)
+
+# everything that affects the output of each engine, for the cache key
+ENGINE_CONFIGS = {'gcp': GCP_CONFIG,
+                  'ctpn': CTPN_CONFIG,
+                  'pytesseract': RECOGNITION_CONFIG}
+
+
+def validate_passport(form_data: Dict,
+                      ocr_text: Text,
+                      mrz_text: Text) -> Dict:
+    """
+    Validate the passport form fields submitted by index.html
+    against the text extracted from the passport photo
+    """
+    return validate_form(form_data=form_data,
+                         ocr_text=ocr_text,
+                         mrz_text=mrz_text,
+                         surname_field='surname',
+                         name_field='givenName',
+                         gender_field='gender',
+                         dob_field='dob',
+                         passport_num_field='passportNumber',
+                         nationality_field='nationality',
+                         expiry_field='passportExpiryDate')
+
+
+def detect_text(engine: Text, image_bytes: bytes) -> List[Text]:
+    """
+    Extract chunks of text from an image with the given engine,
+    reusing cached results for images seen before
+    :param engine: one of ENGINES
+    :param image_bytes: image to detect text/perform ocr on
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine: {}'.format(engine))
+
+    # engines are only loaded on a cache miss
+    return ocr_cache.get_or_compute(
+        image_bytes, engine=engine, config=ENGINE_CONFIGS[engine],
+        compute=lambda: engines.get(engine)(image_bytes))
+
+
+def detect_text_batch_gcp(images_bytes: List[bytes]) -> List[Optional[List[Text]]]:
+    """
+    Extract chunks of text from several images with google cloud vision,
+    only sending images that are not cached yet. Images that could not
+    be annotated yield None, and are not cached
+    :param images_bytes: images to detect text/perform ocr on
+    """
+    keys = [OCRCache.make_key(image_bytes, 'gcp', GCP_CONFIG)
+            for image_bytes in images_bytes]
+    results = [ocr_cache.get(key) for key in keys]
+    missing = [index for index, result in enumerate(results) if result is None]
+    detected = detect_text_gcp_batch([images_bytes[index] for index in missing])
+    for index, text_chunks in zip(missing, detected):
+        results[index] = text_chunks
+        if text_chunks is not None:
+            # do not cache images that could not be annotated
+            ocr_cache.set(keys[index], text_chunks)
+    return results
+
+
+def validate_text_chunks(engine: Text,
+                         text_chunks: List[Text],
+                         form_data: Dict) -> Dict:
+    """
+    Validate form data against the text chunks extracted by an engine
+    """
+    ocr_text = process_text(text_chunks)
+    if not text_chunks:
+        mrz_text = ''
+    elif engine == 'pytesseract':
+        mrz_text = extract_mrz_from_pairs(text_chunks)
+    else:
+        mrz_text = extract_mrz_from_chunks(text_chunks)
+    return validate_passport(form_data=form_data,
+                             ocr_text=ocr_text,
+                             mrz_text=mrz_text)
+
+
+def validate_image(engine: Text,
+                   image_bytes: bytes,
+                   form_data: Dict) -> Dict:
+    """
+    Run the full pipeline on a passport photo: extract text with the
+    given engine and validate form data against it
+    :param engine: one of ENGINES
+    :param image_bytes: passport photo
+    :param form_data: Dict of form fields {field: value}
+    """
+    text_chunks = detect_text(engine, image_bytes)
+    return validate_text_chunks(engine, text_chunks, form_data)
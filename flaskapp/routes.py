@@ -1,13 +1,14 @@
-from flask import render_template, jsonify, request, abort
+from flask import render_template, jsonify, request, abort, url_for
 
 from flaskapp import app
-from flaskapp.analysis.gcp.vision_gcp import detect_text_gcp
-from flaskapp.analysis.ctpn.vision_ctpn import detect_text_ctpn
-from flaskapp.analysis.pytesseract.vision_pytesseract import detect_text_pytesseract
-from flaskapp.analysis.utils.text_utils import (process_text,
-                                                extract_mrz_from_chunks,
-                                                extract_mrz_from_pairs)
-from flaskapp.analysis.utils.validate_form import validate_form
+from flaskapp.jobs import JobQueue, QueueFull
+from flaskapp.pipeline import (ENGINES,
+                               ocr_cache,
+                               detect_text_batch_gcp,
+                               validate_text_chunks,
+                               validate_image)
+
+job_queue = JobQueue.from_env()
 
 
 @app.route('/')
@@ -21,42 +22,50 @@ def result_gcp():
         abort(400)
 
     image_bytes = request.files['passportPhoto'].read()
-    text_chunks = detect_text_gcp(image_bytes)
-    ocr_text = process_text(text_chunks)
-    mrz_text = extract_mrz_from_chunks(text_chunks)
-    validation = validate_form(form_data=request.form,
-                               ocr_text=ocr_text,
-                               mrz_text=mrz_text,
-                               surname_field='surname',
-                               name_field='givenName',
-                               gender_field='gender',
-                               dob_field='dob',
-                               passport_num_field='passportNumber',
-                               nationality_field='nationality',
-                               expiry_field='passportExpiryDate')
+    validation = validate_image(engine='gcp',
+                                image_bytes=image_bytes,
+                                form_data=request.form)
     return jsonify(validation), 200
 
 
+@app.route('/result_gcp_batch', methods=['POST'])
+def result_gcp_batch():
+    """
+    Validate several passports at once. Each form field and passportPhoto
+    is repeated once per passport, in the same order. Returns a list
+    with the validation of each passport (or an error for photos google
+    cloud vision could not annotate).
+    """
+    photos = request.files.getlist('passportPhoto')
+    if not photos or not all(photos):
+        abort(400)
+
+    form_fields = {field: request.form.getlist(field) for field in request.form}
+    if any(len(values) != len(photos) for values in form_fields.values()):
+        abort(400)
+
+    images_bytes = [photo.read() for photo in photos]
+    validations = []
+    for index, text_chunks in enumerate(detect_text_batch_gcp(images_bytes)):
+        if text_chunks is None:
+            validations.append({'error': 'Text could not be detected in this image'})
+            continue
+        form_data = {field: values[index] for field, values in form_fields.items()}
+        validations.append(validate_text_chunks(engine='gcp',
+                                                text_chunks=text_chunks,
+                                                form_data=form_data))
+    return jsonify(validations), 200
+
+
 @app.route('/result_ctpn', methods=['POST'])
 def result_ctpn():
     if not request.files['passportPhoto']:
         abort(400)
 
     image_bytes = request.files['passportPhoto'].read()
-    text_chunks = detect_text_ctpn(image_bytes=image_bytes,
-                                   sess=app.config['tf_session'])
-    ocr_text = process_text(text_chunks)
-    mrz_text = extract_mrz_from_chunks(text_chunks)
-    validation = validate_form(form_data=request.form,
-                               ocr_text=ocr_text,
-                               mrz_text=mrz_text,
-                               surname_field='surname',
-                               name_field='givenName',
-                               gender_field='gender',
-                               dob_field='dob',
-                               passport_num_field='passportNumber',
-                               nationality_field='nationality',
-                               expiry_field='passportExpiryDate')
+    validation = validate_image(engine='ctpn',
+                                image_bytes=image_bytes,
+                                form_data=request.form)
     return jsonify(validation), 200
 
 
@@ -66,17 +75,47 @@ def result_pytesseract():
         abort(400)
 
     image_bytes = request.files['passportPhoto'].read()
-    text_chunks = detect_text_pytesseract(image_bytes=image_bytes)
-    ocr_text = process_text(text_chunks)
-    mrz_text = extract_mrz_from_pairs(text_chunks)
-    validation = validate_form(form_data=request.form,
-                               ocr_text=ocr_text,
-                               mrz_text=mrz_text,
-                               surname_field='surname',
-                               name_field='givenName',
-                               gender_field='gender',
-                               dob_field='dob',
-                               passport_num_field='passportNumber',
-                               nationality_field='nationality',
-                               expiry_field='passportExpiryDate')
+    validation = validate_image(engine='pytesseract',
+                                image_bytes=image_bytes,
+                                form_data=request.form)
     return jsonify(validation), 200
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue a passport for validation with the engine given in the
+    'engine' form field (default: ctpn) and return the job immediately.
+    Poll GET /jobs/<job_id> until its status is 'done' or 'failed'.
+    """
+    engine = request.form.get('engine', 'ctpn')
+    if engine not in ENGINES or not request.files.get('passportPhoto'):
+        abort(400)
+
+    image_bytes = request.files['passportPhoto'].read()
+    try:
+        job = job_queue.submit(validate_image, engine, image_bytes,
+                               request.form.to_dict(), engine=engine)
+    except QueueFull:
+        abort(503)
+
+    response = jsonify(job)
+    response.headers['Location'] = url_for('get_job', job_id=job['id'])
+    return response, 202
+
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """
+    Return the status of a job, with the validation
+    in 'result' once the job is done
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job), 200
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(ocr_cache.stats()), 200
@@ -0,0 +1,19 @@
+"""
+Gunicorn configuration, used by the Procfile.
+
+With GUNICORN_PRELOAD=1 the app is imported once in the master and workers
+are forked from it. Combined with CTPN_MMAP_DIR, the master maps the CTPN
+weights once and all workers share those pages, so adding workers does not
+multiply resident memory by the size of the model.
+"""
+
+import os
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
+
+
+def post_fork(server, worker):
+    # engines are not loaded by a preloading master, load them in the worker
+    if preload_app:
+        from flaskapp.engines import preload_engines
+        preload_engines()